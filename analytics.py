@@ -0,0 +1,212 @@
+import sqlite3
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+# Growth analytics for the admin panel, computed with NumPy over columnar copies of the activity tables.
+# Raw user_activity covers the retention window; user_active_days and activity_daily hold older history.
+
+LOAD_CHUNK_SIZE = 200000
+
+_cache = {"version": None, "result": None}
+
+
+class ActivityFrame:
+    """ستون‌های فشرده فعالیت کاربران: کد int32 کاربر، روز epoch و کد نوع فعالیت"""
+    def __init__(self, user, day, event_day, kind, kinds, rollup_day, rollup_kind, rollup_count, join_day):
+        # One row per (user, day) on which the user was active, raw and rolled-up history combined
+        self.user = user
+        self.day = day
+        # One row per raw event, plus per-day counts for rolled-up history
+        self.event_day = event_day
+        self.kind = kind
+        self.kinds = kinds
+        self.rollup_day = rollup_day
+        self.rollup_kind = rollup_kind
+        self.rollup_count = rollup_count
+        # Join day of each user code
+        self.join_day = join_day
+
+
+def local_day_offset():
+    """اختلاف ساعت محلی با UTC به ثانیه؛ روزها مثل ستون‌های متنی به وقت محلی شمرده می‌شوند"""
+    return time.localtime().tm_gmtoff
+
+
+def to_epoch_days(texts):
+    """تبدیل رشته‌های YYYY-MM-DD به شماره روز از 1970-01-01"""
+    if not texts:
+        return np.empty(0, dtype=np.int32)
+    return np.array(texts, dtype="datetime64[D]").astype(np.int32)
+
+
+def data_version(conn):
+    """نسخه داده‌ها از شمارنده‌های تجمیعی؛ با هر کاربر یا فعالیت جدید تغییر می‌کند"""
+    totals = dict(conn.execute("SELECT key, value FROM stats_totals WHERE key IN ('total_users', 'total_commands')"))
+    return totals.get("total_users", 0), totals.get("total_commands", 0), date.today().isoformat()
+
+
+def load(conn):
+    """خواندن فعالیت‌ها به صورت ستونی از پایگاه داده"""
+    offset = local_day_offset()
+    kinds = {}
+    raw_users, raw_days, raw_kinds = [], [], []
+    cur = conn.execute("SELECT user_id, ts, activity_type FROM user_activity WHERE ts IS NOT NULL")
+    while True:
+        rows = cur.fetchmany(LOAD_CHUNK_SIZE)
+        if not rows:
+            break
+        raw_users.append(np.fromiter((row[0] for row in rows), np.int64, len(rows)))
+        raw_days.append((np.fromiter((row[1] for row in rows), np.int64, len(rows)) + offset) // 86400)
+        raw_kinds.append(np.fromiter((kinds.setdefault(row[2], len(kinds)) for row in rows), np.int16, len(rows)))
+    raw_users = np.concatenate(raw_users) if raw_users else np.empty(0, np.int64)
+    raw_days = np.concatenate(raw_days).astype(np.int32) if raw_days else np.empty(0, np.int32)
+    raw_kinds = np.concatenate(raw_kinds) if raw_kinds else np.empty(0, np.int16)
+
+    rows = conn.execute("SELECT user_id, day FROM user_active_days").fetchall()
+    old_users = np.fromiter((row[0] for row in rows), np.int64, len(rows))
+    old_days = to_epoch_days([row[1] for row in rows])
+
+    rows = conn.execute("SELECT day, activity_type, count FROM activity_daily").fetchall()
+    rollup_day = to_epoch_days([row[0] for row in rows])
+    rollup_kind = np.fromiter((kinds.setdefault(row[1], len(kinds)) for row in rows), np.int16, len(rows))
+    rollup_count = np.fromiter((row[2] for row in rows), np.int64, len(rows))
+
+    rows = conn.execute("SELECT user_id, join_ts FROM users").fetchall()
+    member_ids = np.fromiter((row[0] for row in rows), np.int64, len(rows))
+    # -1 marks users without a join time; their first active day is used instead
+    member_join = np.fromiter(((row[1] + offset) // 86400 if row[1] is not None else -1 for row in rows), np.int64, len(rows))
+
+    # Telegram ids do not fit in int32, so users are factorized into dense int32 codes
+    user_ids, codes = np.unique(np.concatenate([raw_users, old_users, member_ids]), return_inverse=True)
+    codes = codes.astype(np.int32)
+    raw_codes = codes[:len(raw_users)]
+    old_codes = codes[len(raw_users):len(raw_users) + len(old_users)]
+    member_codes = codes[len(raw_users) + len(old_users):]
+
+    # Distinct (user, day) pairs packed into one int64 key
+    day = np.concatenate([raw_days, old_days]).astype(np.int64)
+    keys = np.unique(np.concatenate([raw_codes, old_codes]).astype(np.int64) << 32 | day)
+    active_user = (keys >> 32).astype(np.int32)
+    active_day = (keys & 0xFFFFFFFF).astype(np.int32)
+
+    join_day = np.full(len(user_ids), np.iinfo(np.int32).max, dtype=np.int64)
+    np.minimum.at(join_day, active_user, active_day)
+    known = member_join >= 0
+    join_day[member_codes[known]] = member_join[known]
+
+    # Codes were handed out in insertion order, so the names list is indexed by code
+    return ActivityFrame(active_user, active_day, raw_days, raw_kinds, list(kinds),
+                         rollup_day, rollup_kind, rollup_count, join_day.astype(np.int32))
+
+
+def active_users(frame, today, window):
+    """تعداد کاربران یکتای فعال در window روز منتهی به today"""
+    mask = (frame.day > today - window) & (frame.day <= today)
+    return int(np.unique(frame.user[mask]).size)
+
+
+def daily_active_series(frame, today, days):
+    """تعداد کاربران فعال هر روز در days روز گذشته"""
+    first = today - days + 1
+    mask = (frame.day >= first) & (frame.day <= today)
+    # Pairs are already distinct per (user, day), so a bincount gives DAU directly
+    return np.bincount(frame.day[mask] - first, minlength=days)
+
+
+def weekly_retention(frame, today, weeks):
+    """ماتریس ماندگاری هفتگی: سطر هفته عضویت، ستون تعداد هفته‌های پس از آن"""
+    # Epoch day 4 (1970-01-05) is a Monday, so weeks start on Monday
+    this_week = (today + 3) // 7
+    first_cohort = this_week - weeks + 1
+
+    cohort = (frame.join_day.astype(np.int64) + 3) // 7
+    in_range = (cohort >= first_cohort) & (cohort <= this_week)
+    sizes = np.bincount(cohort[in_range] - first_cohort, minlength=weeks)
+
+    user_cohort = cohort[frame.user]
+    active_week = (frame.day.astype(np.int64) + 3) // 7
+    offset = active_week - user_cohort
+    mask = (user_cohort >= first_cohort) & (user_cohort <= this_week) & (offset >= 0) & (active_week <= this_week)
+    # Distinct (user, week) first, then count users per (cohort, offset) cell
+    keys = np.unique(frame.user[mask].astype(np.int64) << 32 | active_week[mask])
+    users = (keys >> 32).astype(np.int64)
+    cells = (cohort[users] - first_cohort) * weeks + ((keys & 0xFFFFFFFF) - cohort[users])
+    retained = np.bincount(cells, minlength=weeks * weeks).reshape(weeks, weeks)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = np.where(sizes[:, None] > 0, retained / sizes[:, None], 0.0)
+    # Offsets that have not happened yet are marked with -1
+    elapsed = this_week - (first_cohort + np.arange(weeks))
+    rates[np.arange(weeks)[None, :] > elapsed[:, None]] = -1
+    starts = [(date(1970, 1, 1) + timedelta(days=int(week) * 7 - 3)).isoformat()
+              for week in range(first_cohort, this_week + 1)]
+    return starts, sizes, rates
+
+
+def activity_trends(frame, today, months):
+    """تعداد فعالیت‌ها به تفکیک نوع در months ماه اخیر"""
+    to_month = lambda days: days.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    this_month = int(to_month(np.array([today]))[0])
+    first = this_month - months + 1
+    kinds = len(frame.kinds)
+
+    counts = np.zeros(months * max(kinds, 1), dtype=np.int64)
+    for days, kind, weights in ((frame.event_day, frame.kind, None),
+                                (frame.rollup_day, frame.rollup_kind, frame.rollup_count)):
+        month = to_month(days) - first
+        mask = (month >= 0) & (month < months)
+        cells = kind[mask].astype(np.int64) * months + month[mask]
+        counts += np.bincount(cells, weights=None if weights is None else weights[mask],
+                              minlength=len(counts)).astype(np.int64)[:len(counts)]
+
+    labels = [str(np.datetime64(first + i, "M")) for i in range(months)]
+    return labels, {name: counts[code * months:(code + 1) * months].tolist() for code, name in enumerate(frame.kinds)}
+
+
+def compute(frame, today, weeks=12, months=6, days=30):
+    """محاسبه همه شاخص‌های رشد از روی یک ActivityFrame"""
+    mau = active_users(frame, today, 30)
+    dau = active_users(frame, today, 1)
+    cohort_starts, cohort_sizes, retention = weekly_retention(frame, today, weeks)
+    trend_months, trends = activity_trends(frame, today, months)
+    return {
+        "users": int(frame.join_day.size),
+        "dau": dau,
+        "wau": active_users(frame, today, 7),
+        "mau": mau,
+        "stickiness": dau / mau if mau else 0.0,
+        "dau_series": daily_active_series(frame, today, days).tolist(),
+        "cohort_starts": cohort_starts,
+        "cohort_sizes": cohort_sizes.tolist(),
+        "retention": retention.tolist(),
+        "trend_months": trend_months,
+        "trends": trends,
+    }
+
+
+def report(db_file):
+    """شاخص‌های رشد با cache؛ فقط وقتی داده جدید رسیده باشد دوباره محاسبه می‌شود"""
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    try:
+        version = data_version(conn)
+        if _cache["version"] == version:
+            return dict(_cache["result"], cached=True)
+
+        started = time.perf_counter()
+        frame = load(conn)
+        loaded = time.perf_counter()
+        today = int(np.datetime64(date.today(), "D").astype(np.int64))
+        result = compute(frame, today)
+        result.update(
+            rows=int(frame.event_day.size + frame.rollup_count.sum()),
+            load_seconds=loaded - started,
+            compute_seconds=time.perf_counter() - loaded,
+            memory_bytes=sum(column.nbytes for column in (frame.user, frame.day, frame.kind, frame.event_day, frame.join_day)),
+        )
+    finally:
+        conn.close()
+    _cache["version"] = version
+    _cache["result"] = result
+    return dict(result, cached=False)
@@ -0,0 +1,361 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+# Offline load test for bot.py: handlers run against a stub Telegram client and a throwaway database.
+# Usage: python benchmark.py [--quick] [--output results.json]
+
+
+class StubUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.first_name = "Bench"
+        self.last_name = str(user_id)
+        self.access_hash = user_id * 7919
+
+
+class StubMessage:
+    def __init__(self, message_id, chat_id, message="", media=None):
+        self.id = message_id
+        self.chat_id = chat_id
+        self.message = message
+        self.text = message
+        self.media = media
+
+
+class StubClient:
+    """کلاینت شبیه‌سازی شده تلگرام که پیام‌ها را ثبت و خطاهای FloodWait و بلاک را تزریق می‌کند"""
+    def __init__(self, flood_rate=0.0, flood_seconds=1, blocked_rate=0.0, latency=0.0, seed=1,
+                 threshold_client=None):
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.blocked_rate = blocked_rate
+        self.latency = latency
+        # Like Telethon, waits up to the client's flood_sleep_threshold are slept through and retried;
+        # the threshold is read from the real client so its property is what gets exercised
+        self.threshold_client = threshold_client
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.message_ids = 0
+
+    async def _request(self, method, entity=None):
+        from telethon.errors import FloodWaitError, UserIsBlockedError
+
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if entity is not None and method in ("send_message", "forward_messages"):
+            roll = self.random.random()
+            while roll < self.flood_rate:
+                threshold = self.threshold_client.flood_sleep_threshold if self.threshold_client else 60
+                if self.flood_seconds > threshold:
+                    self.errors["FloodWaitError"] += 1
+                    raise FloodWaitError(None, capture=self.flood_seconds)
+                self.errors["FloodWaitSlept"] += 1
+                await asyncio.sleep(self.flood_seconds)
+                roll = self.random.random()
+            if roll < self.flood_rate + self.blocked_rate:
+                self.errors["UserIsBlockedError"] += 1
+                raise UserIsBlockedError(None)
+        self.message_ids += 1
+        return StubMessage(self.message_ids, entity)
+
+    async def send_message(self, entity, message="", **kwargs):
+        return await self._request("send_message", entity)
+
+    async def forward_messages(self, entity, messages, **kwargs):
+        return await self._request("forward_messages", entity)
+
+    async def edit_message(self, entity, message=None, text=None, **kwargs):
+        return await self._request("edit_message")
+
+    async def get_messages(self, entity, ids=None, **kwargs):
+        self.calls["get_messages"] += 1
+        return StubMessage(ids, entity, "benchmark broadcast")
+
+    async def get_input_entity(self, entity):
+        self.calls["get_input_entity"] += 1
+        return entity
+
+
+class StubEvent:
+    """رویداد NewMessage یا CallbackQuery شبیه‌سازی شده"""
+    def __init__(self, client, sender_id, text="", data=None):
+        self.client = client
+        self.sender_id = sender_id
+        self.chat_id = sender_id
+        self.raw_text = text
+        self.text = text
+        self.data = data
+        self.is_private = True
+        self.message = StubMessage(1, sender_id, text)
+
+    async def get_sender(self):
+        self.client.calls["get_sender"] += 1
+        return StubUser(self.sender_id)
+
+    async def get_input_sender(self):
+        self.client.calls["get_input_sender"] += 1
+        return StubUser(self.sender_id)
+
+    async def respond(self, *args, **kwargs):
+        return await self.client._request("respond")
+
+    async def reply(self, *args, **kwargs):
+        return await self.client._request("reply")
+
+    async def edit(self, *args, **kwargs):
+        return await self.client._request("edit")
+
+    async def answer(self, *args, **kwargs):
+        return await self.client._request("answer")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+def latency_summary(samples):
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "max_ms": max(samples) * 1000,
+    }
+
+
+async def deliver(bot, handlers, event):
+    """تحویل رویداد مصنوعی از همان مسیر Telethon: wrapper ثبت شده و صف UpdateScheduler"""
+    from telethon import events
+
+    for callback, builder in handlers:
+        if event.data is None:
+            matched = isinstance(builder, events.NewMessage)
+        else:
+            matched = isinstance(builder, events.CallbackQuery) and builder.match(event.data)
+        if matched:
+            await callback(event)
+
+
+async def settle(bot):
+    """انتظار تا پردازش همه update های صف زمان‌بند"""
+    await bot.scheduler.queue.join()
+
+
+async def bench_start(bot, client, handlers, updates, users):
+    """پردازش به‌روزرسانی‌های /start از مسیر UpdateScheduler"""
+    events = [StubEvent(client, 1_000_000 + i % users, "/start") for i in range(updates)]
+    # Same as bot startup
+    bot.known_users.load(await bot.db.get_known_user_ids())
+    started = time.perf_counter()
+    for event in events:
+        # Blocks while the scheduler queue is full, like Telethon's update loop
+        await deliver(bot, handlers, event)
+    await settle(bot)
+    await bot.db.flush_activity()
+    elapsed = time.perf_counter() - started
+    return {"updates": updates, "distinct_users": users, "workers": bot.scheduler.workers,
+            "seconds": elapsed, "updates_per_second": updates / elapsed, "throttled": bot.user_throttle.shed,
+            "known_users": bot.known_users.stats()}
+
+
+async def bench_db_writes(bot, events):
+    """نوشتن فعالیت‌ها از مسیر بافر و flush"""
+    started = time.perf_counter()
+    for i in range(events):
+        await bot.db.update_user_activity(1_000_000 + i % 1000, "benchmark")
+    await bot.db.flush_activity()
+    elapsed = time.perf_counter() - started
+    return {"events": events, "seconds": elapsed, "events_per_second": events / elapsed,
+            "last_flush_ms": bot.db.database.flush_stats["last_latency"] * 1000}
+
+
+def seed_rows(db_file, users, activity_rows, already):
+    """درج مستقیم کاربران و فعالیت‌های مصنوعی تا رسیدن به activity_rows"""
+    conn = sqlite3.connect(db_file)
+    conn.execute("PRAGMA synchronous = OFF")
+    now = int(time.time())
+    rng = random.Random(already)
+    if not already:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, join_date, last_activity, join_ts, last_activity_ts, is_active, access_hash) "
+            "VALUES (?, ?, 'Bench', '', ?, ?, ?, ?, 1, ?)",
+            ((2_000_000 + i, f"seed{i}", datetime.fromtimestamp(now - i).strftime('%Y-%m-%d %H:%M:%S'),
+              datetime.fromtimestamp(now - i).strftime('%Y-%m-%d %H:%M:%S'), now - i, now - i, (2_000_000 + i) * 7919)
+             for i in range(users))
+        )
+        conn.commit()
+    chunk = 200_000
+    for offset in range(already, activity_rows, chunk):
+        rows = []
+        for _ in range(min(chunk, activity_rows - offset)):
+            ts = now - rng.randrange(90 * 86400)
+            rows.append((2_000_000 + rng.randrange(users), rng.choice(("start_command", "shared_peer")),
+                         datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'), ts))
+        conn.executemany("INSERT INTO user_activity (user_id, activity_type, timestamp, ts) VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+    conn.close()
+
+
+async def bench_stats(bot, client, handlers, admin_id, repeats):
+    """زمان پاسخ پنل آمار و پرس‌وجوی آمار"""
+    query, panel = [], []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        await bot.db.get_user_stats()
+        query.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        await deliver(bot, handlers, StubEvent(client, admin_id, "📊 آمار کاربران"))
+        await settle(bot)
+        panel.append(time.perf_counter() - started)
+    return {"get_user_stats": latency_summary(query), "stats_panel": latency_summary(panel)}
+
+
+async def bench_broadcast(bot, client, handlers, admin_id, recipients):
+    """ارسال گروهی به recipients کاربر از مسیر پنل ادمین، دکمه تایید و اجرای کار در worker"""
+    total = await bot.db.count_active_users()
+    if total < recipients:
+        raise SystemExit(f"Only {total} active users seeded, need {recipients}")
+    # Panel button, broadcast type, the message itself, then the inline confirm button
+    for text in ("📤 ارسال پیام به همه", "📋 ارسال بدون نام (Copy)", "benchmark broadcast"):
+        await deliver(bot, handlers, StubEvent(client, admin_id, text))
+        await settle(bot)
+    started = time.perf_counter()
+    await deliver(bot, handlers, StubEvent(client, admin_id, data=b"confirm_broadcast"))
+    await settle(bot)
+    confirm_seconds = time.perf_counter() - started
+    queued = await bot.jobs.active("broadcast")
+    if not queued:
+        raise SystemExit("confirm_broadcast did not queue a broadcast job")
+    sends_before = client.calls["send_message"]
+    started = time.perf_counter()
+    # What the worker process does after claiming the job
+    await bot.run_job(queued[-1])
+    elapsed = time.perf_counter() - started
+    job = await bot.db.get_broadcast_job(queued[-1]["payload"]["broadcast_job_id"])
+    attempts = client.calls["send_message"] - sends_before
+    return {"confirm_ms": confirm_seconds * 1000,
+            "recipients": job["successful_sends"] + job["failed_sends"], "sent": job["successful_sends"],
+            "failed": job["failed_sends"], "send_attempts": attempts, "seconds": elapsed,
+            "messages_per_second": (job["successful_sends"] + job["failed_sends"]) / elapsed}
+
+
+async def run(args, bot):
+    client = StubClient(args.flood_rate, args.flood_seconds, args.blocked_rate, args.latency,
+                        threshold_client=bot.bot)
+    # Registered on the real client; each one submits to UpdateScheduler like a live update would
+    handlers = bot.bot.list_event_handlers()
+    # Handlers look the client up as a module global, so swapping it reroutes every API call
+    bot.bot = client
+    bot.scheduler.start()
+    admin_id = next(iter(bot.ADMIN_IDS))
+    results = {}
+
+    results["start"] = await bench_start(bot, client, handlers, args.start_updates, args.start_users)
+    results["db_writes"] = await bench_db_writes(bot, args.db_events)
+
+    results["stats"] = {}
+    seeded = 0
+    for rows in args.activity_rows:
+        await bot.db.flush_activity()
+        seed_rows(bot.db.db_file, max(args.recipients, args.seed_users), rows, seeded)
+        seeded = rows
+        results["stats"][str(rows)] = await bench_stats(bot, client, handlers, admin_id, args.stats_repeats)
+    if not args.activity_rows:
+        seed_rows(bot.db.db_file, max(args.recipients, args.seed_users), 0, 0)
+
+    results["broadcast"] = await bench_broadcast(bot, client, handlers, admin_id, args.recipients)
+    await bot.scheduler.stop()
+    results["stub_calls"] = dict(client.calls)
+    results["injected_errors"] = dict(client.errors)
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark for bot.py with a stub Telegram client")
+    parser.add_argument("--quick", action="store_true", help="small sizes for a smoke run")
+    parser.add_argument("--start-updates", type=int, default=20000)
+    parser.add_argument("--start-users", type=int, default=5000)
+    parser.add_argument("--workers", type=int, help="UpdateScheduler workers (default: SCHEDULER_WORKERS)")
+    parser.add_argument("--db-events", type=int, default=100000)
+    parser.add_argument("--activity-rows", default="1000000,10000000",
+                        help="comma-separated user_activity sizes at which the stats panel is measured")
+    parser.add_argument("--seed-users", type=int, default=100000)
+    parser.add_argument("--stats-repeats", type=int, default=20)
+    parser.add_argument("--recipients", type=int, default=100000)
+    parser.add_argument("--broadcast-rate", type=float, default=100000,
+                        help="token bucket rate; high by default to measure engine overhead, not Telegram limits")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probability of a FloodWaitError per send")
+    parser.add_argument("--flood-seconds", type=int, default=1)
+    parser.add_argument("--blocked-rate", type=float, default=0.02, help="probability of a blocked recipient per send")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per API call")
+    parser.add_argument("--workdir", help="directory for the benchmark databases (default: a temp dir)")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+    if args.quick:
+        args.start_updates, args.start_users, args.db_events = 2000, 500, 10000
+        args.activity_rows, args.seed_users, args.stats_repeats, args.recipients = "100000", 10000, 5, 10000
+    args.activity_rows = [int(rows) for rows in args.activity_rows.split(",") if rows.strip()]
+    return args
+
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bot_benchmark_")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+
+    # bot.py reads its settings at import time
+    os.environ.setdefault("API_ID", "1")
+    os.environ.setdefault("API_HASH", "benchmark")
+    os.environ.setdefault("BOT_TOKEN", "benchmark")
+    os.environ["ADMIN_IDS"] = os.environ.get("ADMIN_IDS") or "1"
+    os.environ["METRICS_PORT"] = "0"
+    os.environ["SPAWN_WORKER"] = "0"
+    os.environ["BROADCAST_RATE"] = str(args.broadcast_rate)
+    if args.workers:
+        os.environ["SCHEDULER_WORKERS"] = str(args.workers)
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+
+    started = time.perf_counter()
+    try:
+        results = asyncio.run(run(args, bot))
+    finally:
+        bot.admin_states.close()
+        bot.jobs.close()
+        bot.db.close()
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "workdir": workdir,
+        "params": {key: value for key, value in vars(args).items() if key not in ("output", "workdir")},
+        "total_seconds": time.perf_counter() - started,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,257 @@
 
 
-from telethon import TelegramClient, events, Button
+import time
+STARTUP_STARTED = time.perf_counter()
+
+from telethon import TelegramClient, events, Button, utils
 from telethon.tl.functions.channels import GetParticipantRequest
 from telethon.tl.functions.messages import GetDialogsRequest
 from telethon.tl.types import (
-    ReplyKeyboardMarkup, KeyboardButtonRequestPeer, KeyboardButtonRow,
+    ReplyKeyboardMarkup, InputKeyboardButtonRequestPeer, KeyboardButtonRow,
     RequestPeerTypeBroadcast, RequestPeerTypeChat,
-    ChatAdminRights, InputPeerUser
+    ChatAdminRights, InputPeerUser, UpdateNewMessage, MessageService,
+    MessageActionRequestedPeer, MessageActionRequestedPeerSentMe,
+    RequestedPeerChannel, Channel
+)
+from telethon.errors import (
+    ChatAdminRequiredError, ChannelPrivateError, FloodWaitError, ServerError,
+    UserIsBlockedError, InputUserDeactivatedError, UserDeactivatedError, PeerIdInvalidError
 )
-from telethon.errors import ChatAdminRequiredError, ChannelPrivateError
 import asyncio
+import bisect
+import contextvars
+import csv
+import functools
+import gzip
+import heapq
+import html
+import importlib
+import importlib.util
+import itertools
 import logging
 import os
+import shutil
+import signal
 import sqlite3
-from datetime import datetime
+import tempfile
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import io
-import pandas as pd
+import json
+import sys
 try:
-    import matplotlib.pyplot as plt
-    HAS_MATPLOTLIB = True
+    import resource
 except ImportError:
-    HAS_MATPLOTLIB = False
+    resource = None
 from dotenv import load_dotenv
 
+# The reporting stack is only needed by admin buttons and is imported on first use
+HAS_MATPLOTLIB = importlib.util.find_spec("matplotlib") is not None
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None
+
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+@functools.lru_cache(maxsize=None)
+def lazy_import(name):
+    """وارد کردن یک ماژول سنگین در اولین استفاده"""
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    logger.info(f"Loaded {name} in {(time.perf_counter() - started) * 1000:.0f} ms")
+    return module
+
 load_dotenv()
 API_ID = os.getenv('API_ID')
 API_HASH = os.getenv('API_HASH')
 BOT_TOKEN = os.getenv('BOT_TOKEN')
-ADMIN_IDS = os.getenv('ADMIN_IDS', '').split(',')  
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv('ADMIN_IDS', '').split(',') if admin_id.strip()}
+ACTIVITY_FLUSH_SIZE = int(os.getenv('ACTIVITY_FLUSH_SIZE', '200'))
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '2'))
+# Events kept for retry while flushes fail; the oldest are dropped beyond this
+ACTIVITY_BUFFER_MAX = int(os.getenv('ACTIVITY_BUFFER_MAX', '50000'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', '3'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '500'))
+# Delivery results are committed every this many sends, so a crash re-sends at most this many plus those in flight
+BROADCAST_COMMIT_EVERY = int(os.getenv('BROADCAST_COMMIT_EVERY', '20'))
+REPORT_CHUNK_SIZE = int(os.getenv('REPORT_CHUNK_SIZE', '5000'))
+CHART_CACHE_TTL = float(os.getenv('CHART_CACHE_TTL', '300'))
+ENTITY_CACHE_SIZE = int(os.getenv('ENTITY_CACHE_SIZE', '10000'))
+ENTITY_CACHE_TTL = float(os.getenv('ENTITY_CACHE_TTL', '3600'))
+ADMIN_STATE_BACKEND = os.getenv('ADMIN_STATE_BACKEND', 'memory')
+ADMIN_STATE_TTL = float(os.getenv('ADMIN_STATE_TTL', '3600'))
+ADMIN_STATE_MAXSIZE = int(os.getenv('ADMIN_STATE_MAXSIZE', '1000'))
+ACTIVITY_RETENTION_DAYS = int(os.getenv('ACTIVITY_RETENTION_DAYS', '90'))
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '5000'))
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', '3600'))
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+JOBS_DB_FILE = os.getenv('JOBS_DB_FILE', 'jobs.db')
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+JOB_WORKER_CONCURRENCY = int(os.getenv('JOB_WORKER_CONCURRENCY', '3'))
+# A job that was running this many times when the worker died is failed instead of requeued
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# A running job whose worker has not renewed its lease for this long is treated as crashed
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '60'))
+SPAWN_WORKER = os.getenv('SPAWN_WORKER', '1') == '1'
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# The worker serves its metrics on METRICS_PORT + 1; 0 disables the endpoint
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', '0.01'))
+# Per-user limit on commands and shared chats: sustained rate per second, burst size and tracked users
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', '0.2'))
+THROTTLE_BURST = float(os.getenv('THROTTLE_BURST', '5'))
+THROTTLE_MAXSIZE = int(os.getenv('THROTTLE_MAXSIZE', '100000'))
+SCHEDULER_QUEUE_SIZE = int(os.getenv('SCHEDULER_QUEUE_SIZE', '1000'))
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', '16'))
+# Messages older than this are treated as a redelivered backlog (catch-up mode)
+SCHEDULER_STALE_AFTER = float(os.getenv('SCHEDULER_STALE_AFTER', '30'))
+# Raw updates allowed to pile up inside Telethon while the scheduler queue is full; beyond it user updates are shed
+SCHEDULER_BACKLOG_LIMIT = int(os.getenv('SCHEDULER_BACKLOG_LIMIT', '5000'))
+# Heavy admin jobs run in a separate process started with `python bot.py --worker`
+WORKER_MODE = '--worker' in sys.argv
 
 if not all([API_ID, API_HASH, BOT_TOKEN]):
     raise ValueError("please set API_ID، API_HASH و BOT_TOKEN in .env ")
 
-bot = TelegramClient('chatlist_bot', API_ID, API_HASH)
+class Metrics:
+    """شمارنده‌ها، gauge ها و هیستوگرام‌های داخلی با خروجی متنی Prometheus"""
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    
+    def __init__(self):
+        # name -> {label tuple: value}; only touched from the event loop thread
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+    
+    def inc(self, name, amount=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + amount
+    
+    def set(self, name, value, **labels):
+        self.gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+    
+    def observe(self, name, value, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        # Per-bucket (non-cumulative) counts followed by sum and count
+        data = series.get(key)
+        if data is None:
+            data = series[key] = [0] * (len(self.BUCKETS) + 1) + [0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(self.BUCKETS)
+        data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+    
+    def quantile(self, data, q):
+        """برآورد صدک از روی حد بالای بازه‌های هیستوگرام"""
+        target = q * data[-1]
+        seen = 0
+        for i, bound in enumerate(self.BUCKETS):
+            seen += data[i]
+            if seen >= target:
+                return bound
+        return float("inf")
+    
+    @staticmethod
+    def _labels(key, **extra):
+        pairs = list(key) + list(extra.items())
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+    
+    def render(self):
+        """خروجی متنی قابل خواندن توسط Prometheus"""
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{self._labels(key)} {value}" for key, value in series.items())
+        for name, series in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(f"{name}{self._labels(key)} {value}" for key, value in series.items())
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for key, data in series.items():
+                cumulative = 0
+                for i, bound in enumerate(self.BUCKETS):
+                    cumulative += data[i]
+                    lines.append(f"{name}_bucket{self._labels(key, le=bound)} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(key, le='+Inf')} {data[-1]}")
+                lines.append(f"{name}_sum{self._labels(key)} {data[-2]}")
+                lines.append(f"{name}_count{self._labels(key)} {data[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+
+# Per-task override of the client's flood_sleep_threshold. Telethon sleeps through any FLOOD_WAIT
+# up to the threshold (60 s by default) without raising, so broadcast senders set it to 0
+FLOOD_SLEEP_THRESHOLD = contextvars.ContextVar("flood_sleep_threshold", default=None)
+
+
+class InstrumentedTelegramClient(TelegramClient):
+    """TelegramClient که تعداد، زمان و خطاهای درخواست‌های API را ثبت می‌کند"""
+    # Telethon ignores the per-call argument and reads this property when a FLOOD_WAIT arrives
+    @property
+    def flood_sleep_threshold(self):
+        override = FLOOD_SLEEP_THRESHOLD.get()
+        return self._flood_sleep_threshold if override is None else override
+    
+    @flood_sleep_threshold.setter
+    def flood_sleep_threshold(self, value):
+        TelegramClient.flood_sleep_threshold.fset(self, value)
+    
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        method = type(request).__name__ if not isinstance(request, list) else "batch"
+        started = time.perf_counter()
+        try:
+            return await super().__call__(request, ordered=ordered, flood_sleep_threshold=flood_sleep_threshold)
+        except Exception as e:
+            metrics.inc("bot_telegram_api_errors_total", method=method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.inc("bot_telegram_api_calls_total", method=method)
+            metrics.observe("bot_telegram_api_seconds", time.perf_counter() - started, method=method)
+
+
+def timed_handler(func):
+    """ثبت زمان اجرا و خطاهای یک handler در metrics"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=func.__name__)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=func.__name__)
+    return wrapper
+
+
+# The worker only sends results, so it uses its own session and ignores updates.
+# Updates are handled one at a time by Telethon and only enqueued into UpdateScheduler,
+# so a backlog waits in a bounded queue instead of becoming one task per update.
+bot = InstrumentedTelegramClient(
+    'chatlist_worker' if WORKER_MODE else 'chatlist_bot', API_ID, API_HASH,
+    receive_updates=not WORKER_MODE, sequential_updates=True
+)
 
 WELCOME_MESSAGE = """ربات به شما کمک میکند کانال ها و گروه هایی که مالک یا ادمین آن هستید ببینید، حتی اگر قبلا از آنها لفت داده اید.
 اطلاعات بیشتر: https://tginfo.me/how-to-find-my-chats-en/
@@ -52,14 +266,86 @@ WELCOME_MESSAGE = """ربات به شما کمک میکند کانال ها و 
 
 ربات بصورت بخشی از پروژه @AlphaTeam_bots ساخته شده است"""
 
+def archive_activity_rows(archive_dir, day, rows):
+    """افزودن ردیف‌های فعالیت یک روز به فایل فشرده بایگانی همان روز"""
+    directory = os.path.join(archive_dir, "user_activity", day[:7])
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{day}.csv.gz")
+    is_new = not os.path.exists(path)
+    # Each append is a separate gzip member; gzip readers concatenate them transparently
+    with gzip.open(path, "at", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if is_new:
+            writer.writerow(["id", "user_id", "activity_type", "timestamp", "ts"])
+        writer.writerows(rows)
+
+
 class Database:
     def __init__(self, db_file="users.db"):
-        self.conn = sqlite3.connect(db_file)
+        self.db_file = db_file
+        # The connection is owned by AsyncDatabase's single DB thread; a larger statement
+        # cache keeps every query the bot issues prepared
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, cached_statements=256)
         self.cur = self.conn.cursor()
+        self.activity_buffer = []
+        self.flush_failed_at = 0.0
+        self.flush_stats = {"flushes": 0, "events": 0, "last_size": 0, "last_latency": 0.0, "failures": 0, "dropped": 0}
         self.setup()
         
+    # (schema version, migration method); applied in order and tracked with PRAGMA user_version
+    MIGRATIONS = [
+        (1, "_migrate_base_schema"),
+        (2, "_migrate_epoch_timestamps"),
+        (3, "_migrate_indexes"),
+        (4, "_migrate_activity_rollups"),
+        (5, "_migrate_access_hash"),
+        (6, "_migrate_export_watermarks"),
+    ]
+    
+    # (table, TEXT time column, INTEGER epoch column)
+    EPOCH_COLUMNS = [
+        ("users", "join_date", "join_ts"),
+        ("users", "last_activity", "last_activity_ts"),
+        ("user_activity", "timestamp", "ts"),
+        ("message_broadcasts", "sent_date", "sent_ts"),
+    ]
+    
     def setup(self):
-        """ایجاد جداول مورد نیاز"""
+        """تنظیم اتصال، اجرای مهاجرت‌ها و آماده‌سازی جداول آماری"""
+        self.configure()
+        self.migrate()
+        self.backfill_stats()
+    
+    def configure(self):
+        """تنظیمات اتصال برای خواندن و نوشتن هم‌زمان ربات و worker"""
+        # Only takes effect on a new database; pruned pages are then reclaimed with incremental_vacuum
+        self.cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.cur.execute("PRAGMA journal_mode = WAL")
+        # With WAL, NORMAL only risks the last transactions on power loss, never corruption
+        self.cur.execute("PRAGMA synchronous = NORMAL")
+        self.cur.execute("PRAGMA busy_timeout = 5000")
+        self.cur.execute("PRAGMA temp_store = MEMORY")
+        self.cur.execute("PRAGMA cache_size = -16000")
+    
+    def migrate(self):
+        """اجرای مهاجرت‌های اعمال نشده، هر کدام در یک تراکنش"""
+        self.cur.execute("PRAGMA user_version")
+        version = self.cur.fetchone()[0]
+        for target, name in self.MIGRATIONS:
+            if target <= version:
+                continue
+            logger.info(f"Migrating database to schema version {target} ({name})")
+            self.cur.execute("BEGIN")
+            try:
+                getattr(self, name)()
+                self.cur.execute(f"PRAGMA user_version = {target}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+    
+    def _migrate_base_schema(self):
+        """جداول پایه؛ برای پایگاه‌داده‌های قدیمی بدون شماره نسخه نیز بی‌خطر است"""
         self.cur.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -94,97 +380,654 @@ class Database:
             successful_sends INTEGER
         )
         ''')
+        
+        self.cur.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            source_chat_id INTEGER,
+            source_message_id INTEGER,
+            status_message_id INTEGER,
+            message_text TEXT,
+            broadcast_type TEXT,
+            status TEXT DEFAULT 'running',
+            last_user_id INTEGER DEFAULT 0,
+            successful_sends INTEGER DEFAULT 0,
+            failed_sends INTEGER DEFAULT 0,
+            created_date TEXT,
+            updated_date TEXT
+        )
+        ''')
+        
+        self.cur.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER,
+            user_id INTEGER,
+            status TEXT,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+        ''')
+        
+        # Pre-aggregated counters for the admin stats panel
+        self.cur.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            new_users INTEGER DEFAULT 0,
+            active_users INTEGER DEFAULT 0
+        ) WITHOUT ROWID
+        ''')
+        
+        self.cur.execute('''
+        CREATE TABLE IF NOT EXISTS stats_activity (
+            activity_type TEXT PRIMARY KEY,
+            count INTEGER DEFAULT 0
+        ) WITHOUT ROWID
+        ''')
+        
+        self.cur.execute('''
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            key TEXT PRIMARY KEY,
+            value INTEGER DEFAULT 0
+        ) WITHOUT ROWID
+        ''')
+    
+    def _migrate_epoch_timestamps(self):
+        """افزودن ستون‌های زمان عددی (epoch) و پر کردن آن‌ها از ستون‌های متنی"""
+        for table, text_column, epoch_column in self.EPOCH_COLUMNS:
+            self.cur.execute(f"ALTER TABLE {table} ADD COLUMN {epoch_column} INTEGER")
+            # Stored strings are local time; the 'utc' modifier converts them before taking the epoch
+            self.cur.execute(
+                f"UPDATE {table} SET {epoch_column} = CAST(strftime('%s', {text_column}, 'utc') AS INTEGER) WHERE {text_column} IS NOT NULL"
+            )
+    
+    def _migrate_indexes(self):
+        """ایندکس‌های مورد نیاز پرس‌وجوهای آمار و گزارش"""
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_user_activity_user_id ON user_activity (user_id)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_user_activity_ts ON user_activity (ts)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_users_last_activity_ts ON users (last_activity_ts)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_users_join_ts ON users (join_ts)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_message_broadcasts_sent_ts ON message_broadcasts (sent_ts)")
+    
+    def _migrate_activity_rollups(self):
+        """جداول تجمیعی برای فعالیت‌های قدیمی‌تر از بازه نگهداری"""
+        self.cur.execute('''
+        CREATE TABLE IF NOT EXISTS activity_daily (
+            day TEXT,
+            activity_type TEXT,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (day, activity_type)
+        ) WITHOUT ROWID
+        ''')
+        self.cur.execute('''
+        CREATE TABLE IF NOT EXISTS user_active_days (
+            user_id INTEGER,
+            day TEXT,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+        ''')
+    
+    def backfill_stats(self):
+        """پر کردن یک‌باره جداول آمار تجمیعی از داده‌های موجود"""
+        self.cur.execute("SELECT value FROM stats_totals WHERE key = 'rollup_backfilled'")
+        if self.cur.fetchone():
+            return
+        
+        logger.info("Backfilling stats rollup tables...")
+        self.cur.execute("DELETE FROM stats_daily")
+        self.cur.execute("DELETE FROM stats_activity")
+        self.cur.execute("DELETE FROM stats_totals")
+        self.cur.execute('''
+        INSERT INTO stats_daily (day, new_users)
+        SELECT date(join_date), COUNT(*) FROM users WHERE join_date IS NOT NULL GROUP BY 1
+        ''')
+        self.cur.execute('''
+        INSERT INTO stats_daily (day, active_users)
+        SELECT day, COUNT(*) FROM (
+            SELECT DISTINCT date(timestamp) AS day, user_id FROM user_activity WHERE timestamp IS NOT NULL
+        ) GROUP BY day
+        ON CONFLICT(day) DO UPDATE SET active_users = excluded.active_users
+        ''')
+        self.cur.execute('''
+        INSERT INTO stats_activity (activity_type, count)
+        SELECT activity_type, COUNT(*) FROM user_activity GROUP BY activity_type
+        ''')
+        self.cur.execute('''
+        INSERT INTO stats_totals (key, value)
+        SELECT 'total_users', COUNT(*) FROM users
+        UNION ALL SELECT 'total_commands', COALESCE(SUM(commands_used), 0) FROM users
+        UNION ALL SELECT 'rollup_backfilled', 1
+        ''')
         self.conn.commit()
     
-    def add_user(self, user_id, username, first_name, last_name):
+    def _increment_total(self, key, amount):
+        self.cur.execute(
+            "INSERT INTO stats_totals (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+            (key, amount)
+        )
+    
+    def add_user(self, user_id, username, first_name, last_name, access_hash=None):
         """افزودن کاربر جدید به پایگاه داده"""
         current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        now = int(time.time())
         self.cur.execute(
-            "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, join_date, last_activity) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, username, first_name, last_name, current_time, current_time)
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, join_date, last_activity, join_ts, last_activity_ts, access_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, username, first_name, last_name, current_time, current_time, now, now, access_hash)
         )
+        if self.cur.rowcount == 0 and access_hash is not None:
+            # Existing user: only touches the row when the hash is new or changed
+            self.cur.execute(
+                "UPDATE users SET access_hash = ? WHERE user_id = ? AND access_hash IS NOT ?",
+                (access_hash, user_id, access_hash)
+            )
+        elif self.cur.rowcount == 1:
+            # A new user also counts as active on the day they join
+            self.cur.execute(
+                "INSERT INTO stats_daily (day, new_users, active_users) VALUES (?, 1, 1) ON CONFLICT(day) DO UPDATE SET new_users = new_users + 1, active_users = active_users + 1",
+                (current_time[:10],)
+            )
+            self._increment_total("total_users", 1)
         self.conn.commit()
     
     def update_user_activity(self, user_id, activity_type):
-        """بروزرسانی فعالیت کاربر"""
+        """ثبت فعالیت کاربر در بافر؛ نوشتن در پایگاه داده با flush_activity انجام می‌شود"""
+        if len(self.activity_buffer) >= ACTIVITY_BUFFER_MAX:
+            # Flushes are failing; new events are counted and dropped instead of growing the buffer
+            self.flush_stats["dropped"] += 1
+            return
         current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.activity_buffer.append((user_id, activity_type, current_time, int(time.time())))
         
-        self.cur.execute(
-            "UPDATE users SET last_activity = ?, commands_used = commands_used + 1 WHERE user_id = ?",
-            (current_time, user_id)
-        )
+        # After a failed flush, retries are left to the periodic flusher instead of every new event
+        if len(self.activity_buffer) >= ACTIVITY_FLUSH_SIZE and time.monotonic() - self.flush_failed_at >= ACTIVITY_FLUSH_INTERVAL:
+            self.flush_activity()
+    
+    def flush_activity(self):
+        """نوشتن فعالیت‌های بافر شده در یک تراکنش"""
+        if not self.activity_buffer:
+            return 0
         
-        self.cur.execute(
-            "INSERT INTO user_activity (user_id, activity_type, timestamp) VALUES (?, ?, ?)",
-            (user_id, activity_type, current_time)
-        )
-        self.conn.commit()
+        events = self.activity_buffer
+        self.activity_buffer = []
+        started = time.perf_counter()
+        
+        # Collapse the per-event UPDATEs into one row per user
+        per_user = {}
+        active_days = {}
+        for user_id, _, timestamp, ts in events:
+            count = per_user[user_id][0] if user_id in per_user else 0
+            per_user[user_id] = (count + 1, timestamp, ts)
+            active_days.setdefault(user_id, set()).add(timestamp[:10])
+        
+        try:
+            # Must run before last_activity is overwritten below
+            self.cur.executemany(
+                "INSERT INTO stats_daily (day, active_users) VALUES (?, ?) ON CONFLICT(day) DO UPDATE SET active_users = active_users + excluded.active_users",
+                self._first_active_days(active_days).items()
+            )
+            self.cur.executemany(
+                "INSERT INTO stats_activity (activity_type, count) VALUES (?, ?) ON CONFLICT(activity_type) DO UPDATE SET count = count + excluded.count",
+                Counter(event[1] for event in events).items()
+            )
+            self._increment_total("total_commands", len(events))
+            self.cur.executemany(
+                "UPDATE users SET last_activity = ?, last_activity_ts = ?, commands_used = commands_used + ?, is_active = 1 WHERE user_id = ?",
+                [(timestamp, ts, count, user_id) for user_id, (count, timestamp, ts) in per_user.items()]
+            )
+            self.cur.executemany(
+                "INSERT INTO user_activity (user_id, activity_type, timestamp, ts) VALUES (?, ?, ?, ?)",
+                events
+            )
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            # Keep the events so the next flush retries them, but never more than ACTIVITY_BUFFER_MAX
+            retained = events + self.activity_buffer
+            dropped = max(0, len(retained) - ACTIVITY_BUFFER_MAX)
+            self.activity_buffer = retained[:ACTIVITY_BUFFER_MAX]
+            self.flush_stats["failures"] += 1
+            self.flush_failed_at = time.monotonic()
+            self.flush_stats["dropped"] += dropped
+            logger.error(f"Error flushing activity buffer ({len(self.activity_buffer)} kept, {dropped} dropped): {e}")
+            return 0
+        
+        latency = time.perf_counter() - started
+        self.flush_stats["flushes"] += 1
+        self.flush_stats["events"] += len(events)
+        self.flush_stats["last_size"] = len(events)
+        self.flush_stats["last_latency"] = latency
+        logger.debug(f"Flushed {len(events)} activity events in {latency * 1000:.1f} ms")
+        return len(events)
     
-    def get_all_users(self):
-        """دریافت تمام کاربران فعال"""
-        self.cur.execute("SELECT user_id FROM users WHERE is_active = 1")
-        return [row[0] for row in self.cur.fetchall()]
+    def _first_active_days(self, active_days):
+        """تعداد کاربرانی که برای اولین بار در هر روز فعال شده‌اند"""
+        counts = Counter()
+        user_ids = list(active_days)
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            self.cur.execute(
+                f"SELECT user_id, last_activity FROM users WHERE user_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for user_id, last_activity in self.cur.fetchall():
+                last_day = (last_activity or "")[:10]
+                counts.update(day for day in active_days[user_id] if day > last_day)
+        return counts
+    
+    def count_active_users(self):
+        """تعداد کاربران فعال"""
+        self.cur.execute("SELECT COUNT(*) FROM users WHERE is_active = 1")
+        return self.cur.fetchone()[0]
     
     def get_user_stats(self):
-        """دریافت آمار کاربران برای پنل ادمین"""
-        self.cur.execute("SELECT COUNT(*) FROM users")
-        total_users = self.cur.fetchone()[0]
+        """دریافت آمار کاربران برای پنل ادمین از جداول تجمیعی"""
+        self.flush_activity()
         
-        self.cur.execute("SELECT COUNT(*) FROM users WHERE datetime(last_activity) > datetime('now', '-1 day')")
-        active_users_24h = self.cur.fetchone()[0]
+        self.cur.execute("SELECT key, value FROM stats_totals WHERE key IN ('total_users', 'total_commands')")
+        totals = dict(self.cur.fetchall())
+        
+        today = datetime.now().strftime('%Y-%m-%d')
+        self.cur.execute("SELECT active_users FROM stats_daily WHERE day = ?", (today,))
+        row = self.cur.fetchone()
+        active_users_today = row[0] if row else 0
         
-        self.cur.execute("SELECT COUNT(*) FROM users WHERE datetime(join_date) > datetime('now', '-7 days')")
-        new_users_7d = self.cur.fetchone()[0]
+        # Index range scan on last_activity_ts
+        self.cur.execute("SELECT COUNT(*) FROM users WHERE last_activity_ts > ?", (int(time.time()) - 86400,))
+        active_users_24h = self.cur.fetchone()[0]
         
-        self.cur.execute("SELECT SUM(commands_used) FROM users")
-        total_commands = self.cur.fetchone()[0] or 0
+        daily_new_users = self.get_daily_new_users(7)
         
-        self.cur.execute("""
-        SELECT activity_type, COUNT(*) as count 
-        FROM user_activity 
-        GROUP BY activity_type 
-        ORDER BY count DESC
-        """)
+        self.cur.execute("SELECT activity_type, count FROM stats_activity ORDER BY count DESC")
         activity_stats = self.cur.fetchall()
         
-        self.cur.execute("""
-        SELECT date(join_date) as day, COUNT(*) as count 
-        FROM users 
-        WHERE datetime(join_date) > datetime('now', '-7 days')
-        GROUP BY day
-        ORDER BY day
-        """)
-        daily_new_users = self.cur.fetchall()
-        
         return {
-            "total_users": total_users,
+            "total_users": totals.get("total_users", 0),
             "active_users_24h": active_users_24h,
-            "new_users_7d": new_users_7d,
-            "total_commands": total_commands,
+            "active_users_today": active_users_today,
+            "new_users_7d": sum(count for _, count in daily_new_users),
+            "total_commands": totals.get("total_commands", 0),
             "activity_stats": activity_stats,
             "daily_new_users": daily_new_users
         }
     
+    def get_daily_new_users(self, days):
+        """تعداد کاربران جدید در هر روز برای چند روز اخیر"""
+        since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        self.cur.execute(
+            "SELECT day, new_users FROM stats_daily WHERE day >= ? AND new_users > 0 ORDER BY day",
+            (since,)
+        )
+        return self.cur.fetchall()
+    
     def log_broadcast(self, admin_id, message_text, broadcast_type, total_recipients, successful_sends):
         """ثبت ارسال پیام گروهی"""
         current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         self.cur.execute(
-            "INSERT INTO message_broadcasts (admin_id, message_text, broadcast_type, sent_date, total_recipients, successful_sends) VALUES (?, ?, ?, ?, ?, ?)",
-            (admin_id, message_text, broadcast_type, current_time, total_recipients, successful_sends)
+            "INSERT INTO message_broadcasts (admin_id, message_text, broadcast_type, sent_date, sent_ts, total_recipients, successful_sends) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (admin_id, message_text, broadcast_type, current_time, int(time.time()), total_recipients, successful_sends)
+        )
+        self.conn.commit()
+    
+    def create_broadcast_job(self, admin_id, source_chat_id, source_message_id, status_message_id, message_text, broadcast_type):
+        """ایجاد یک کار ارسال گروهی قابل ادامه"""
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.cur.execute(
+            "INSERT INTO broadcast_jobs (admin_id, source_chat_id, source_message_id, status_message_id, message_text, broadcast_type, created_date, updated_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (admin_id, source_chat_id, source_message_id, status_message_id, message_text, broadcast_type, current_time, current_time)
+        )
+        self.conn.commit()
+        return self.cur.lastrowid
+    
+    def get_broadcast_job(self, job_id):
+        """دریافت اطلاعات یک کار ارسال گروهی"""
+        self.cur.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,))
+        row = self.cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in self.cur.description], row))
+    
+    def get_unfinished_broadcast_jobs(self):
+        """شناسه کارهای ارسال گروهی نیمه‌تمام"""
+        self.cur.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+        return [row[0] for row in self.cur.fetchall()]
+    
+    def count_broadcast_recipients(self, job_id, after_user_id):
+        """تعداد دریافت‌کنندگان باقی‌مانده یک کار ارسال گروهی"""
+        self.cur.execute(
+            """SELECT COUNT(*) FROM users u
+            WHERE u.is_active = 1 AND u.user_id > ?
+            AND NOT EXISTS (SELECT 1 FROM broadcast_deliveries d WHERE d.job_id = ? AND d.user_id = u.user_id)""",
+            (after_user_id, job_id)
+        )
+        return self.cur.fetchone()[0]
+    
+    def get_export_watermarks(self, admin_id):
+        """watermark های گزارش تغییرات یک ادمین به صورت {جدول: مقدار}"""
+        self.cur.execute("SELECT table_name, value FROM export_watermarks WHERE admin_id = ?", (admin_id,))
+        return dict(self.cur.fetchall())
+    
+    def set_export_watermarks(self, admin_id, watermarks):
+        """ثبت watermark ها پس از ارسال موفق گزارش تغییرات"""
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.cur.executemany(
+            "INSERT INTO export_watermarks (admin_id, table_name, value, updated_date) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(admin_id, table_name) DO UPDATE SET value = excluded.value, updated_date = excluded.updated_date",
+            [(admin_id, table, value, current_time) for table, value in watermarks.items()]
+        )
+        self.conn.commit()
+    
+    def get_known_user_ids(self):
+        """شناسه کاربرانی که ثبت‌نام کامل دارند، مرتب شده در یک آرایه فشرده"""
+        self.cur.execute("SELECT user_id FROM users WHERE access_hash IS NOT NULL ORDER BY user_id")
+        return array('q', (row[0] for row in self.cur))
+    
+    def get_broadcast_recipients(self, job_id, after_user_id, limit):
+        """دسته بعدی دریافت‌کنندگان به صورت (شناسه، access_hash) به ترتیب شناسه (صفحه‌بندی keyset)"""
+        self.cur.execute(
+            """SELECT u.user_id, u.access_hash FROM users u
+            WHERE u.is_active = 1 AND u.user_id > ?
+            AND NOT EXISTS (SELECT 1 FROM broadcast_deliveries d WHERE d.job_id = ? AND d.user_id = u.user_id)
+            ORDER BY u.user_id
+            LIMIT ?""",
+            (after_user_id, job_id, limit)
+        )
+        return self.cur.fetchall()
+    
+    def record_broadcast_deliveries(self, job_id, results, last_user_id=None):
+        """ثبت نتیجه ارسال برای هر دریافت‌کننده و در صورت نیاز جابجایی نقطه بازیابی"""
+        if not results and last_user_id is None:
+            return
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        sent = sum(1 for _, status in results if status == "sent")
+        self.cur.executemany(
+            "INSERT OR REPLACE INTO broadcast_deliveries (job_id, user_id, status) VALUES (?, ?, ?)",
+            [(job_id, user_id, status) for user_id, status in results]
+        )
+        # Users that blocked the bot or deleted their account are skipped from now on
+        self.cur.executemany(
+            "UPDATE users SET is_active = 0 WHERE user_id = ?",
+            [(user_id,) for user_id, status in results if status == "blocked"]
+        )
+        self.cur.execute(
+            """UPDATE broadcast_jobs SET successful_sends = successful_sends + ?, failed_sends = failed_sends + ?,
+            last_user_id = COALESCE(?, last_user_id), updated_date = ? WHERE id = ?""",
+            (sent, len(results) - sent, last_user_id, current_time, job_id)
+        )
+        self.conn.commit()
+    
+    def finish_broadcast_job(self, job_id, status="done"):
+        """پایان دادن به یک کار ارسال گروهی"""
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.cur.execute(
+            "UPDATE broadcast_jobs SET status = ?, updated_date = ? WHERE id = ?",
+            (status, current_time, job_id)
         )
         self.conn.commit()
     
+    def _migrate_access_hash(self):
+        """access_hash کاربر برای ساخت InputPeerUser بدون نیاز به cache نشست"""
+        self.cur.execute("ALTER TABLE users ADD COLUMN access_hash INTEGER")
+    
+    def _migrate_export_watermarks(self):
+        """آخرین سطر خروجی گرفته شده هر ادمین از هر جدول برای گزارش تغییرات"""
+        self.cur.execute('''
+        CREATE TABLE IF NOT EXISTS export_watermarks (
+            admin_id INTEGER,
+            table_name TEXT,
+            value INTEGER,
+            updated_date TEXT,
+            PRIMARY KEY (admin_id, table_name)
+        ) WITHOUT ROWID
+        ''')
+    
+    def prune_activity(self, cutoff_ts, batch_size, archive_dir):
+        """بایگانی، تجمیع و حذف یک دسته از فعالیت‌های قدیمی‌تر از cutoff_ts"""
+        self.cur.execute(
+            "SELECT id, user_id, activity_type, timestamp, ts FROM user_activity WHERE ts < ? ORDER BY ts LIMIT ?",
+            (cutoff_ts, batch_size)
+        )
+        rows = self.cur.fetchall()
+        if not rows:
+            return 0
+        
+        # Archive first: a crash before the commit below can only duplicate archived rows, never lose them
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(row[3][:10], []).append(row)
+        for day, day_rows in by_day.items():
+            archive_activity_rows(archive_dir, day, day_rows)
+        
+        daily = Counter((row[3][:10], row[2]) for row in rows)
+        try:
+            self.cur.executemany(
+                "INSERT INTO activity_daily (day, activity_type, count) VALUES (?, ?, ?) "
+                "ON CONFLICT(day, activity_type) DO UPDATE SET count = count + excluded.count",
+                [(day, activity_type, count) for (day, activity_type), count in daily.items()]
+            )
+            self.cur.executemany(
+                "INSERT OR IGNORE INTO user_active_days (user_id, day) VALUES (?, ?)",
+                {(row[1], row[3][:10]) for row in rows}
+            )
+            self.cur.executemany("DELETE FROM user_activity WHERE id = ?", [(row[0],) for row in rows])
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        return len(rows)
+    
+    def auto_vacuum_mode(self):
+        """حالت auto_vacuum پایگاه داده (2 یعنی INCREMENTAL)"""
+        self.cur.execute("PRAGMA auto_vacuum")
+        return self.cur.fetchone()[0]
+    
+    def reclaim_space(self, max_pages):
+        """آزاد کردن تدریجی صفحات خالی فایل پایگاه داده"""
+        self.cur.execute("PRAGMA freelist_count")
+        free_pages = self.cur.fetchone()[0]
+        if free_pages:
+            # The pragma frees one page per step, so the result has to be fetched
+            self.cur.execute(f"PRAGMA incremental_vacuum({int(max_pages)})").fetchall()
+        return min(free_pages, max_pages)
+    
     def close(self):
         """بستن اتصال پایگاه داده"""
+        self.flush_activity()
+        self.conn.close()
+
+
+class JobQueue:
+    """صف پایدار کارهای سنگین ادمین بر پایه SQLite، مشترک بین ربات و worker"""
+    def __init__(self, db_file=JOBS_DB_FILE):
+        self.db_file = db_file
+        # Autocommit mode so claim() can take the write lock explicitly; used from AsyncDatabase's thread
+        self.conn = sqlite3.connect(db_file, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            admin_id INTEGER,
+            payload TEXT,
+            status TEXT DEFAULT 'queued',
+            result TEXT,
+            error TEXT,
+            attempts INTEGER DEFAULT 0,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL
+        )
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)")
+        # Added after the first release; older jobs.db files get the columns here
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in (("worker_id", "TEXT"), ("lease_until", "REAL"), ("dedupe_key", "TEXT")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        # At most one queued or running job per key, e.g. one per broadcast
+        self.conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs (dedupe_key) WHERE status IN ('queued', 'running')"
+        )
+    
+    def enqueue(self, kind, admin_id, dedupe_key=None, **payload):
+        """افزودن کار جدید به صف؛ اگر کاری با همین dedupe_key در صف یا در حال اجرا باشد None برمی‌گردد"""
+        cur = self.conn.execute(
+            "INSERT OR IGNORE INTO jobs (kind, admin_id, payload, created_at, dedupe_key) VALUES (?, ?, ?, ?, ?)",
+            (kind, admin_id, json.dumps(payload), time.time(), dedupe_key)
+        )
+        return cur.lastrowid if cur.rowcount else None
+    
+    def claim(self, worker_id, lease_seconds):
+        """برداشتن قدیمی‌ترین کار در صف با اجاره زمانی؛ فقط یک worker آن را دریافت می‌کند
+        
+        چند worker می‌توانند هم‌زمان کار کنند؛ worker باید اجاره کارهایش را با heartbeat تمدید کند.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1, worker_id = ?, lease_until = ? WHERE id = ?",
+                (time.time(), worker_id, time.time() + lease_seconds, row[0])
+            )
+        finally:
+            self.conn.execute("COMMIT")
+        return self.get(row[0])
+    
+    def complete(self, job_id, result=None):
+        self.conn.execute(
+            "UPDATE jobs SET status = 'done', result = ?, finished_at = ? WHERE id = ?",
+            (json.dumps(result), time.time(), job_id)
+        )
+    
+    def fail(self, job_id, error):
+        self.conn.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+            (error, time.time(), job_id)
+        )
+    
+    def release(self, job_id):
+        """بازگرداندن کار قطع شده با توقف عادی worker به صف، بدون شمردن آن به عنوان تلاش"""
+        self.conn.execute(
+            "UPDATE jobs SET status = 'queued', attempts = attempts - 1 WHERE id = ? AND status = 'running'", (job_id,)
+        )
+    
+    def heartbeat(self, worker_id, lease_seconds):
+        """تمدید اجاره کارهای در حال اجرای یک worker"""
+        self.conn.execute(
+            "UPDATE jobs SET lease_until = ? WHERE status = 'running' AND worker_id = ?",
+            (time.time() + lease_seconds, worker_id)
+        )
+    
+    def requeue_expired(self, max_attempts):
+        """بازگرداندن کارهایی که worker آن‌ها از کار افتاده به صف؛ کارهایی که max_attempts بار worker را از کار انداخته‌اند شکست می‌خورند"""
+        # Only expired leases: a job whose worker is still alive is never handed to a second worker
+        expired = "status = 'running' AND (lease_until IS NULL OR lease_until < ?)"
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = self.conn.execute(f"SELECT * FROM jobs WHERE {expired} AND attempts >= ?", (now, max_attempts))
+            failed = [self._to_dict(cur, row) for row in cur.fetchall()]
+            self.conn.execute(
+                f"UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE {expired} AND attempts >= ?",
+                (f"worker stopped during {max_attempts} attempts", now, now, max_attempts)
+            )
+            requeued = self.conn.execute(f"UPDATE jobs SET status = 'queued' WHERE {expired}", (now,)).rowcount
+        finally:
+            self.conn.execute("COMMIT")
+        return requeued, failed
+    
+    def get(self, job_id):
+        cur = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        row = cur.fetchone()
+        return self._to_dict(cur, row) if row else None
+    
+    def active(self, kind):
+        """کارهای در صف یا در حال اجرا از یک نوع"""
+        cur = self.conn.execute(
+            "SELECT * FROM jobs WHERE kind = ? AND status IN ('queued', 'running') ORDER BY id", (kind,)
+        )
+        return [self._to_dict(cur, row) for row in cur.fetchall()]
+    
+    def recent(self, limit=10):
+        """آخرین کارها برای نمایش در پنل ادمین"""
+        cur = self.conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+        return [self._to_dict(cur, row) for row in cur.fetchall()]
+    
+    @staticmethod
+    def _to_dict(cur, row):
+        job = dict(zip([column[0] for column in cur.description], row))
+        job["payload"] = json.loads(job["payload"] or "{}")
+        return job
+    
+    def close(self):
         self.conn.close()
 
-db = Database()
+class AsyncDatabase:
+    """نسخه غیرهمزمان Database که همه پرس‌وجوها را در یک thread اختصاصی اجرا می‌کند"""
+    def __init__(self, database, name="db"):
+        self.database = database
+        self.db_file = database.db_file
+        # Method labels of other stores are prefixed with their name in metrics
+        self.prefix = "" if name == "db" else f"{name}."
+        # A single thread serializes all access to the shared connection and cursor
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+    
+    def __getattr__(self, name):
+        method = getattr(self.database, name)
+        label = self.prefix + name
+        
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            result = method(*args, **kwargs)
+            return result, time.perf_counter() - started
+        
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            queued = time.perf_counter()
+            try:
+                result, elapsed = await loop.run_in_executor(self.executor, functools.partial(timed, *args, **kwargs))
+            except Exception:
+                metrics.inc("bot_db_errors_total", method=label)
+                raise
+            # Query time is measured in the DB thread; the rest is time spent waiting for it
+            metrics.observe("bot_db_query_seconds", elapsed, method=label)
+            metrics.observe("bot_db_wait_seconds", time.perf_counter() - queued - elapsed, method=label)
+            return result
+        
+        call.__name__ = name
+        # Cache the wrapper so later lookups skip __getattr__
+        setattr(self, name, call)
+        return call
+    
+    def close(self):
+        """نوشتن بافر و بستن اتصال در همان thread پایگاه داده"""
+        self.executor.submit(self.database.close).result()
+        self.executor.shutdown()
+
+db = AsyncDatabase(Database())
+# jobs.db is shared with the other process, whose claim() may hold the write lock for a while
+jobs = AsyncDatabase(JobQueue(), name="jobs")
+STARTUP_IMPORTED = time.perf_counter()
+
+def request_peer_button(text, button_id, peer_type):
+    """ساخت دکمه انتخاب کانال یا گروه"""
+    return InputKeyboardButtonRequestPeer(
+        text=text,
+        button_id=button_id,
+        peer_type=peer_type,
+        max_quantity=1,
+        # Without these Telegram sends the chosen chat back without its title or username
+        name_requested=True,
+        username_requested=True
+    )
 
 def get_main_keyboard():
     return ReplyKeyboardMarkup(
         rows=[
             KeyboardButtonRow(buttons=[
-                KeyboardButtonRequestPeer(
+                request_peer_button(
                     text='لیست کانال‌هایی که ادمین آن هستم',
                     button_id=345,
                     peer_type=RequestPeerTypeBroadcast(
@@ -208,12 +1051,11 @@ def get_main_keyboard():
                             delete_stories=False
                         ),
                         bot_admin_rights=None
-                    ),
-                    max_quantity=1
+                    )
                 )
             ]),
             KeyboardButtonRow(buttons=[
-                KeyboardButtonRequestPeer(
+                request_peer_button(
                     text='لیست گروه‌هایی که ادمین آن هستم',
                     button_id=456,
                     peer_type=RequestPeerTypeChat(
@@ -239,12 +1081,11 @@ def get_main_keyboard():
                             delete_stories=False
                         ),
                         bot_admin_rights=None
-                    ),
-                    max_quantity=1
+                    )
                 )
             ]),
             KeyboardButtonRow(buttons=[
-                KeyboardButtonRequestPeer(
+                request_peer_button(
                     text='لیست کانال‌های من',
                     button_id=123,
                     peer_type=RequestPeerTypeBroadcast(
@@ -252,12 +1093,11 @@ def get_main_keyboard():
                         has_username=None,
                         user_admin_rights=None,
                         bot_admin_rights=None
-                    ),
-                    max_quantity=1
+                    )
                 )
             ]),
             KeyboardButtonRow(buttons=[
-                KeyboardButtonRequestPeer(
+                request_peer_button(
                     text='لیست گروه‌های من',
                     button_id=234,
                     peer_type=RequestPeerTypeChat(
@@ -267,8 +1107,7 @@ def get_main_keyboard():
                         forum=None,
                         user_admin_rights=None,
                         bot_admin_rights=None
-                    ),
-                    max_quantity=1
+                    )
                 )
             ])
         ],
@@ -279,17 +1118,22 @@ def get_main_keyboard():
         placeholder=None
     )
 
-@bot.on(events.NewMessage(pattern='/start'))
+@timed_handler
 async def start_handler(event):
     """مدیریت دستور /start"""
     user_id = event.sender_id
-    user = await event.get_sender()
-    username = user.username or ""
-    first_name = user.first_name or ""
-    last_name = user.last_name or ""
-    
-    db.add_user(user_id, username, first_name, last_name)
-    db.update_user_activity(user_id, "start_command")
+    # Returning users are already registered; skip the sender fetch and the write
+    if not known_users.contains(user_id):
+        user = await event.get_sender()
+        username = user.username or ""
+        first_name = user.first_name or ""
+        last_name = user.last_name or ""
+        access_hash = getattr(user, "access_hash", None)
+        
+        await db.add_user(user_id, username, first_name, last_name, access_hash)
+        if access_hash is not None:
+            known_users.add(user_id)
+    await db.update_user_activity(user_id, "start_command")
     
     welcome_buttons = [
         [
@@ -305,216 +1149,1298 @@ async def start_handler(event):
 
 def is_admin(user_id):
     """بررسی آیا کاربر ادمین است یا خیر"""
-    return str(user_id) in ADMIN_IDS
+    return user_id in ADMIN_IDS
 
-async def create_stats_chart(stats):
-    """ایجاد نمودار آماری برای پنل ادمین و ذخیره به عنوان فایل در حافظه"""
-    # if not HAS_MATPLOTLIB:
-    #     return None
-        
-    if stats["daily_new_users"]:
-        try:
-            days = [record[0] for record in stats["daily_new_users"]]
-            counts = [record[1] for record in stats["daily_new_users"]]
-            
-            plt.figure(figsize=(10, 6))
-            plt.bar(days, counts, color='skyblue')
-            plt.title('New users within last week', fontsize=14)
-            plt.xlabel('Date')
-            plt.ylabel('Count')
-            plt.xticks(rotation=45)
-            plt.tight_layout()
-            
-            # Save the chart directly to disk
-            chart_filename = "admin_stats_chart.png"
-            plt.savefig(chart_filename, format='png')
-            plt.close()
-            
-            return chart_filename
-        except Exception as e:
-            logger.error(f"Error creating chart: {e}")
-            return None
-    return None
+class UserThrottle:
+    """محدودکننده نرخ هر کاربر به روش سطل توکن با حافظه محدود"""
+    def __init__(self, rate, burst, maxsize):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        # A bucket idle this long has refilled completely, which is the same as having none
+        self.idle_after = burst / rate if rate > 0 else 0
+        # user_id -> (tokens, last update), least recently seen first
+        self.buckets = OrderedDict()
+        self.shed = 0
+    
+    def allow(self, user_id):
+        """مصرف یک توکن؛ False یعنی درخواست باید بدون پردازش کنار گذاشته شود"""
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        bucket = self.buckets.pop(user_id, None)
+        tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        else:
+            self.shed += 1
+        self.buckets[user_id] = (tokens, now)
+        self._expire(now)
+        return allowed
+    
+    def _expire(self, now):
+        # Drop refilled buckets from the idle end, and the least recently seen ones beyond maxsize
+        buckets = self.buckets
+        while buckets:
+            user_id, (_, updated) = next(iter(buckets.items()))
+            if len(buckets) <= self.maxsize and now - updated < self.idle_after:
+                break
+            del buckets[user_id]
 
+user_throttle = UserThrottle(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_MAXSIZE)
 
 
-ADMIN_STATE = {}
+def throttled(user_id, kind):
+    """بررسی محدودیت نرخ کاربر؛ ادمین‌ها محدود نمی‌شوند"""
+    if user_id in ADMIN_IDS or user_throttle.allow(user_id):
+        return False
+    metrics.inc("bot_throttled_updates_total", kind=kind)
+    return True
 
-@bot.on(events.NewMessage(pattern='/panel'))
-async def admin_panel(event):
-    """پنل ادمین برای مدیریت ربات"""
-    user_id = event.sender_id
+
+class KnownUsers:
+    """ایندکس فشرده شناسه کاربران ثبت‌شده برای رد شدن از ثبت‌نام تکراری در /start"""
+    # New ids are kept in a set and merged into the sorted array once there are this many
+    MERGE_SIZE = 4096
     
-    if not is_admin(user_id):
-        await event.respond("شما دسترسی به این بخش را ندارید.")
-        return
+    def __init__(self):
+        self.ids = array('q')
+        self.recent = set()
+        self.hits = 0
+        self.misses = 0
     
-    ADMIN_STATE[user_id] = {"state": "main_menu"}
+    def load(self, ids):
+        """جایگزینی ایندکس با آرایه مرتب خوانده شده از پایگاه داده"""
+        self.ids = ids
+        self.recent = set()
     
-    admin_buttons = [
-        [Button.text("📊 آمار کاربران"), Button.text("📤 ارسال پیام به همه")],
-        [Button.text("📋 گزارش فعالیت‌ها"), Button.text("⚙️ تنظیمات")],
-        [Button.text("🔙 بازگشت به منوی اصلی")]
-    ]
+    def contains(self, user_id):
+        """جستجوی دودویی در آرایه و سپس در شناسه‌های جدید؛ نرخ hit را هم ثبت می‌کند"""
+        ids = self.ids
+        i = bisect.bisect_left(ids, user_id)
+        found = (i < len(ids) and ids[i] == user_id) or user_id in self.recent
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
     
-    await event.respond("🔐 به پنل مدیریت خوش آمدید. لطفا گزینه مورد نظر را انتخاب کنید:", buttons=admin_buttons)
-
-@bot.on(events.NewMessage(func=lambda e: e.is_private and e.text in [
-    "📊 آمار کاربران", "📤 ارسال پیام به همه", "📋 گزارش فعالیت‌ها", 
-    "⚙️ تنظیمات", "🔙 بازگشت به منوی اصلی"]))
-async def handle_admin_buttons(event):
-    """مدیریت دکمه‌های پنل ادمین"""
-    user_id = event.sender_id
+    def add(self, user_id):
+        """افزودن کاربر تازه ثبت‌شده"""
+        self.recent.add(user_id)
+        if len(self.recent) >= self.MERGE_SIZE:
+            self.ids = array('q', heapq.merge(self.ids, sorted(self.recent)))
+            self.recent = set()
     
-    if not is_admin(user_id):
-        return
+    def __len__(self):
+        return len(self.ids) + len(self.recent)
     
-    if user_id not in ADMIN_STATE:
-        ADMIN_STATE[user_id] = {"state": "main_menu"}
+    def stats(self):
+        """اندازه، حافظه مصرفی و نرخ hit ایندکس"""
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self),
+            "bytes": self.ids.itemsize * len(self.ids) + sys.getsizeof(self.recent),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+known_users = KnownUsers()
+
+
+class TTLCache:
+    """کش LRU با اندازه محدود و انقضای زمانی"""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
     
-    button_text = event.text
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                del self.data[key]
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[0]
     
-    if button_text == "📊 آمار کاربران":
-        ADMIN_STATE[user_id]["state"] = "stats"
-        stats = db.get_user_stats()
-        
-        stats_text = f"""📊 **آمار ربات**
-
-👥 **آمار کاربران:**
-• کل کاربران: {stats['total_users']} نفر
-• کاربران فعال در 24 ساعت گذشته: {stats['active_users_24h']} نفر
-• کاربران جدید در 7 روز گذشته: {stats['new_users_7d']} نفر
-• کل دستورات اجرا شده: {stats['total_commands']}
+    def set(self, key, value):
+        self.data[key] = (value, time.monotonic() + self.ttl)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+    
+    def stats(self):
+        """اندازه کش و تعداد hit/miss"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
 
-🔝 **فعالیت‌های پرکاربرد:**
-"""
-        for activity, count in stats["activity_stats"][:5]:
-            stats_text += f"• {activity}: {count} بار\n"
-        
-        await event.respond(stats_text)
-        
 
-        chart_buf = await create_stats_chart(stats)
-        if chart_buf:
-            await event.respond("📈 نمودار کاربران جدید در هفته گذشته", 
-                            file=chart_buf)            
-        return
-    elif button_text == "📤 ارسال پیام به همه":
-        ADMIN_STATE[user_id]["state"] = "broadcast_message"
-        
-        broadcast_buttons = [
-            [Button.text("🔄 ارسال با نام (Forward)"), Button.text("📋 ارسال بدون نام (Copy)")],
-            [Button.text("🔙 بازگشت")]
-        ]
-        
-        await event.respond("""🔄 **ارسال پیام به همه کاربران**
+PRIORITY_USER, PRIORITY_ADMIN, PRIORITY_HEAVY = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_USER: "user", PRIORITY_ADMIN: "admin", PRIORITY_HEAVY: "heavy"}
 
-لطفا نوع ارسال را انتخاب کنید:
-- **ارسال با نام (Forward)**: پیام با نام شما ارسال می‌شود
-- **ارسال بدون نام (Copy)**: پیام بدون نام ارسال می‌شود
 
-سپس پیام خود را ارسال کنید.""", buttons=broadcast_buttons)
-        return
+class UpdateScheduler:
+    """صف اولویت‌دار و محدود بین Telethon و handler ها با تعداد ثابت worker"""
+    def __init__(self, maxsize, workers, stale_after, backlog_limit):
+        self.queue = asyncio.PriorityQueue(maxsize)
+        self.workers = workers
+        self.stale_after = stale_after
+        self.backlog_limit = backlog_limit
+        # Keeps FIFO order within a priority class
+        self.sequence = itertools.count()
+        # Users whose stale /start was already queued or answered during catch-up
+        self.recent_starts = TTLCache(maxsize=100000, ttl=max(stale_after * 10, 300))
+        self.tasks = []
+        self.coalesced = 0
+        self.dropped = 0
     
-    elif button_text == "📋 گزارش فعالیت‌ها":
-        try:
-            users_df = pd.read_sql("SELECT * FROM users", db.conn)
-            activity_df = pd.read_sql("SELECT * FROM user_activity", db.conn)
-            broadcast_df = pd.read_sql("SELECT * FROM message_broadcasts", db.conn)
-            
-            file_path = "bot_report.xlsx"
-            with pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
-                users_df.to_excel(writer, sheet_name='Users', index=False)
-                activity_df.to_excel(writer, sheet_name='Activities', index=False)
-                broadcast_df.to_excel(writer, sheet_name='Broadcasts', index=False)
-            
-            from telethon.tl.types import DocumentAttributeFilename
-            await event.respond("📊 گزارش کامل فعالیت‌های ربات", 
-                            file=file_path)
-            
-            import os
-            os.remove(file_path)
-            return
-        except Exception as e:
-            logging.error(f"Error generating report: {str(e)}")
-            await event.respond("❌ خطا در ایجاد گزارش. لطفا بعدا تلاش کنید.")
-            return
-        
-    elif button_text == "⚙️ تنظیمات":
-        await event.respond("⚙️ بخش تنظیمات به زودی اضافه خواهد شد.")
-        return
+    @staticmethod
+    def backlog():
+        """تعداد update های خام در انتظار در صف داخلی Telethon"""
+        # Private attribute; with sequential_updates a blocked submit() leaves new updates there, unbounded
+        updates_queue = getattr(bot, "_updates_queue", None)
+        return updates_queue.qsize() if updates_queue is not None else 0
     
-    elif button_text == "🔙 بازگشت به منوی اصلی":
-        ADMIN_STATE[user_id]["state"] = None
-        await event.respond("انتخاب کنید:", buttons=get_main_keyboard())
-        return
-
-@bot.on(events.NewMessage(func=lambda e: e.is_private and e.text in [
-    "🔄 ارسال با نام (Forward)", "📋 ارسال بدون نام (Copy)", "🔙 بازگشت"]))
-async def broadcast_type_handler(event):
-    """مدیریت انتخاب نوع ارسال پیام گروهی"""
-    user_id = event.sender_id
+    def is_stale(self, event):
+        """آیا update از backlog بازارسال شده پس از راه‌اندازی مجدد است"""
+        message = getattr(event, "message", None)
+        date = getattr(message, "date", None)
+        return date is not None and time.time() - date.timestamp() > self.stale_after
     
-    if not is_admin(user_id):
-        return
-        
-    if user_id not in ADMIN_STATE:
-        ADMIN_STATE[user_id] = {"state": "main_menu"}
+    async def submit(self, priority, handler, event, start_user=None):
+        """افزودن یک update به صف؛ اگر صف پر باشد تا خالی شدن جا منتظر می‌ماند"""
+        if start_user is not None and self.is_stale(event):
+            # A backlog often holds many /start from one user; answering once is enough
+            if self.recent_starts.get(start_user):
+                self.coalesced += 1
+                metrics.inc("bot_scheduler_coalesced_total")
+                return
+            self.recent_starts.set(start_user, True)
+        if self.queue.full():
+            if priority == PRIORITY_USER and self.backlog() >= self.backlog_limit:
+                # Waiting would only grow Telethon's queue further, so user updates are shed to bound memory
+                self.dropped += 1
+                metrics.inc("bot_scheduler_dropped_total")
+                return
+            # Blocking here stalls Telethon's sequential update loop, which is the backpressure
+            metrics.inc("bot_scheduler_backpressure_total")
+        await self.queue.put((priority, next(self.sequence), time.monotonic(), handler, event))
+        metrics.set("bot_scheduler_queue_depth", self.queue.qsize())
     
-    button_text = event.text
+    async def _worker(self):
+        while True:
+            priority, _, queued_at, handler, event = await self.queue.get()
+            metrics.set("bot_scheduler_queue_depth", self.queue.qsize())
+            metrics.observe("bot_scheduler_wait_seconds", time.monotonic() - queued_at, priority=PRIORITY_NAMES[priority])
+            try:
+                await handler(event)
+            except Exception:
+                logger.exception(f"Unhandled error in {handler.__name__}")
+            finally:
+                self.queue.task_done()
     
-    if button_text == "🔙 بازگشت":
-        ADMIN_STATE[user_id]["state"] = "main_menu"
-        admin_buttons = [
-            [Button.text("📊 آمار کاربران"), Button.text("📤 ارسال پیام به همه")],
-            [Button.text("📋 گزارش فعالیت‌ها"), Button.text("⚙️ تنظیمات")],
-            [Button.text("🔙 بازگشت به منوی اصلی")]
-        ]
-        await event.respond("🔐 به پنل مدیریت خوش آمدید. لطفا گزینه مورد نظر را انتخاب کنید:", buttons=admin_buttons)
-        return
-    else:
-        broadcast_type = "forward" if button_text == "🔄 ارسال با نام (Forward)" else "copy"
-        # Store the type but don't process the same message as the broadcast message
-        ADMIN_STATE[user_id] = {"state": "waiting_for_broadcast_message", "type": broadcast_type}
-        await event.respond("✅ لطفا پیامی که می‌خواهید به همه کاربران ارسال شود را ارسال کنید:")
-        return
+    def start(self):
+        """راه‌اندازی worker های ثابت"""
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        """توقف worker ها؛ update های باقی‌مانده در صف رها می‌شوند"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
 
-@bot.on(events.NewMessage(func=lambda e: e.is_private))
-async def receive_broadcast_message(event):
-    """دریافت پیام برای ارسال گروهی"""
-    user_id = event.sender_id
+scheduler = UpdateScheduler(SCHEDULER_QUEUE_SIZE, SCHEDULER_WORKERS, SCHEDULER_STALE_AFTER, SCHEDULER_BACKLOG_LIMIT)
+
+
+def scheduled(event_builder, priority, admit=None):
+    """ثبت handler روی bot از طریق زمان‌بند؛ priority یک عدد یا تابعی از update است
     
-    if not is_admin(user_id):
-        return
+    admit پیش از ورود به صف اجرا می‌شود و update هایی که False برگردانند هیچ جایی در صف نمی‌گیرند.
+    """
+    def decorator(handler):
+        async def enqueue(update):
+            if admit and not admit(update):
+                return
+            if callable(priority):
+                update_priority, start_user = priority(update)
+            else:
+                update_priority, start_user = priority, None
+            await scheduler.submit(update_priority, handler, update, start_user)
         
-    if user_id not in ADMIN_STATE:
-        return
+        bot.add_event_handler(enqueue, event_builder)
+        return handler
+    return decorator
+
+
+def command_name(text):
+    """نام دستور بدون پسوند @نام_ربات؛ مثلا /start@MyBot به /start"""
+    return text.split(maxsplit=1)[0].split("@", 1)[0]
+
+
+def admit_message(event):
+    """پیام‌های بی‌اثر کاربران عادی و دستورات بیش از حد مجاز آن‌ها پیش از صف کنار گذاشته می‌شوند"""
+    if event.sender_id in ADMIN_IDS:
+        return True
+    text = event.raw_text
+    # dispatch ignores anything else from regular users, so it never needs a queue slot
+    if not text.startswith("/") or command_name(text) not in COMMAND_HANDLERS:
+        return False
+    event.throttle_checked = True
+    return not throttled(event.sender_id, "command")
+
+
+def message_priority(event):
+    """اولویت پیام‌ها: کاربران عادی پیش از ادمین؛ /start برای ادغام در حالت catch-up علامت می‌خورد"""
+    if event.sender_id in ADMIN_IDS:
+        return PRIORITY_ADMIN, None
+    if event.raw_text.startswith("/") and command_name(event.raw_text) == "/start":
+        return PRIORITY_USER, event.sender_id
+    return PRIORITY_USER, None
+
+
+CHART_RANGES = {7: "۷ روز", 30: "۳۰ روز", 90: "۹۰ روز", 365: "۳۶۵ روز"}
+chart_cache = TTLCache(maxsize=16, ttl=CHART_CACHE_TTL)
+
+
+def render_stats_chart(days, counts, title):
+    """رسم نمودار و بازگرداندن تصویر PNG؛ برای اجرا خارج از حلقه رویداد"""
+    # Figure is used directly instead of pyplot, which is not thread-safe
+    Figure = lazy_import("matplotlib.figure").Figure
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    ax.bar(range(len(days)), counts, color='skyblue')
+    step = max(1, len(days) // 15)
+    ax.set_xticks(range(0, len(days), step))
+    ax.set_xticklabels(days[::step], rotation=45, ha='right')
+    ax.set_title(title, fontsize=14)
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Count')
+    fig.tight_layout()
+    
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+
+async def create_stats_chart(daily_new_users, days=7):
+    """ایجاد نمودار کاربران جدید برای پنل ادمین به صورت فایل در حافظه"""
+    if not HAS_MATPLOTLIB or not daily_new_users:
+        return None
+    
+    # Days without new users are drawn as zero bars
+    counts_by_day = dict(daily_new_users)
+    first_day = datetime.now().date() - timedelta(days=days - 1)
+    labels = [(first_day + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(days)]
+    counts = [counts_by_day.get(day, 0) for day in labels]
     
-    state = ADMIN_STATE[user_id].get("state")
+    key = (days, tuple(labels), tuple(counts))
+    png = chart_cache.get(key)
+    if png is None:
+        try:
+            loop = asyncio.get_running_loop()
+            png = await loop.run_in_executor(
+                None, render_stats_chart, labels, counts, f'New users within last {days} days'
+            )
+        except Exception as e:
+            logger.error(f"Error creating chart: {e}")
+            return None
+        chart_cache.set(key, png)
+    
+    chart_buf = io.BytesIO(png)
+    chart_buf.name = "stats_chart.png"
+    return chart_buf
+
+
+class PeerResolver:
+    """تبدیل peer های اشتراک گذاشته شده به عنوان و لینک با کش و درخواست‌های دسته‌ای"""
+    def __init__(self, client, cache, batch_delay=0.05):
+        self.client = client
+        self.cache = cache
+        self.batch_delay = batch_delay
+        self.pending = {}
+        self.flush_handle = None
+        self.api_calls = 0
+    
+    async def resolve(self, peers, known=None):
+        """دریافت اطلاعات چت‌ها؛ known موجودیت‌های همراه update است که نیاز به درخواست ندارند"""
+        futures = []
+        for peer in peers:
+            peer_id = utils.get_peer_id(peer)
+            info = self.cache.get(peer_id)
+            if info is None and known and peer_id in known:
+                info = self._describe(known[peer_id])
+                self.cache.set(peer_id, info)
+            if info is not None:
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(info)
+            else:
+                future = self._enqueue(peer_id, peer)
+            futures.append(future)
+        return await asyncio.gather(*futures, return_exceptions=True)
+    
+    def _enqueue(self, peer_id, peer):
+        # Concurrent requests for the same chat share one lookup
+        if peer_id in self.pending:
+            return self.pending[peer_id][1]
+        future = asyncio.get_running_loop().create_future()
+        self.pending[peer_id] = (peer, future)
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                self.batch_delay, lambda: asyncio.ensure_future(self._flush())
+            )
+        return future
     
-    if state == "waiting_for_broadcast_message":
-        # Make sure we're not processing button message text as broadcast content
-        button_texts = ["🔄 ارسال با نام (Forward)", "📋 ارسال بدون نام (Copy)", "🔙 بازگشت"]
-        if event.text in button_texts:
+    async def _flush(self):
+        batch, self.pending, self.flush_handle = self.pending, {}, None
+        if not batch:
             return
-            
-        broadcast_type = ADMIN_STATE[user_id].get("type")
-        message = event.message
         
-        confirm_buttons = [
-            [Button.inline("✅ بله، ارسال شود", data="confirm_broadcast")],
-            [Button.inline("❌ خیر، لغو شود", data="cancel_broadcast")]
-        ]
+        ids = list(batch)
+        self.api_calls += 1
+        try:
+            entities = await self.client.get_entity([batch[peer_id][0] for peer_id in ids])
+            results = list(zip(ids, entities))
+        except Exception as e:
+            # One bad peer fails the whole batch; fall back to one lookup per peer
+            logger.warning(f"Batch entity lookup failed, retrying one by one: {e}")
+            self.api_calls += len(ids)
+            entities = await asyncio.gather(
+                *(self.client.get_entity(batch[peer_id][0]) for peer_id in ids), return_exceptions=True
+            )
+            results = list(zip(ids, entities))
         
-        ADMIN_STATE[user_id]["message"] = message
+        for peer_id, entity in results:
+            future = batch[peer_id][1]
+            if isinstance(entity, Exception):
+                future.set_exception(entity)
+            else:
+                info = self._describe(entity)
+                self.cache.set(peer_id, info)
+                future.set_result(info)
+    
+    @staticmethod
+    def _describe(entity):
+        """اطلاعات فشرده مورد نیاز برای پاسخ (عنوان، لینک)"""
+        title = getattr(entity, "title", None) or utils.get_display_name(entity)
+        if not title:
+            # An empty label would render as an empty message; fall back to the chat id
+            chat_id = getattr(entity, "channel_id", None) or getattr(entity, "chat_id", None) or getattr(entity, "id", None)
+            title = f"چت {chat_id}"
+        username = getattr(entity, "username", None)
+        if username:
+            link = f"https://t.me/{username}"
+        elif isinstance(entity, (Channel, RequestedPeerChannel)):
+            # Private channels and supergroups open through their internal id
+            channel_id = entity.channel_id if isinstance(entity, RequestedPeerChannel) else entity.id
+            link = f"https://t.me/c/{channel_id}/999999999"
+        else:
+            link = None
+        return title, link
+
+
+entity_cache = TTLCache(maxsize=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL)
+peer_resolver = PeerResolver(bot, entity_cache)
+
+# button_id of the main keyboard buttons -> activity name
+SHARED_PEER_BUTTONS = {
+    123: "shared_own_channel",
+    234: "shared_own_group",
+    345: "shared_admin_channel",
+    456: "shared_admin_group",
+}
+
+
+def format_shared_peer(info):
+    """متن پاسخ برای یک چت اشتراک گذاشته شده"""
+    if isinstance(info, Exception):
+        return "❌ اطلاعات این چت در دسترس نیست."
+    title, link = info
+    if link:
+        return f'<a href="{html.escape(link)}">{html.escape(title)}</a>'
+    return f"<b>{html.escape(title)}</b>"
+
+
+def is_shared_peer_update(update):
+    """آیا update پیام سرویس انتخاب چت با دکمه‌های منوی اصلی است"""
+    message = update.message
+    return isinstance(message, MessageService) and isinstance(
+        message.action, (MessageActionRequestedPeer, MessageActionRequestedPeerSentMe))
+
+
+def admit_shared_peer(update):
+    """محدودیت نرخ کاربر پیش از ورود به صف"""
+    update.throttle_checked = True
+    return not throttled(utils.get_peer_id(update.message.peer_id), "shared_peer")
+
+
+# Filtered at registration so ordinary messages never take a scheduler slot
+@scheduled(events.Raw(UpdateNewMessage, func=is_shared_peer_update), PRIORITY_USER, admit_shared_peer)
+@timed_handler
+async def shared_peer_handler(update):
+    """پاسخ به چت‌هایی که کاربر با دکمه‌های منوی اصلی انتخاب کرده است"""
+    message = update.message
+    user_id = utils.get_peer_id(message.peer_id)
+    if not getattr(update, "throttle_checked", False) and throttled(user_id, "shared_peer"):
+        return
+    await db.update_user_activity(user_id, SHARED_PEER_BUTTONS.get(message.action.button_id, "shared_peer"))
+    
+    if isinstance(message.action, MessageActionRequestedPeerSentMe):
+        # Telegram already sent the names along; no lookup needed
+        results = [PeerResolver._describe(peer) for peer in message.action.peers]
+    else:
+        results = await peer_resolver.resolve(message.action.peers, getattr(update, "_entities", None))
+    
+    await bot.send_message(
+        message.peer_id,
+        "\n".join(format_shared_peer(info) for info in results),
+        parse_mode="html",
+        link_preview=False
+    )
+
+
+def get_chart_range_buttons():
+    return [[Button.inline(label, data=f"chart:{days}") for days, label in CHART_RANGES.items()]]
+
+
+class TokenBucket:
+    """محدودکننده نرخ سراسری به روش سطل توکن با کاهش خودکار نرخ هنگام FloodWait"""
+    def __init__(self, rate, capacity=None, min_rate=1.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """انتظار تا آزاد شدن یک توکن"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def penalize(self, seconds):
+        """توقف سراسری و نصف کردن نرخ پس از دریافت FloodWait"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.updated = self.paused_until
+        self.tokens = 0
+        self.rate = max(self.min_rate, self.rate / 2)
+    
+    def reward(self):
+        """افزایش تدریجی نرخ پس از ارسال موفق"""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+
+class BroadcastEngine:
+    """ارسال هم‌زمان پیام گروهی با محدودیت نرخ، تلاش مجدد و گزارش پیشرفت"""
+    # The recipient blocked the bot or deleted their account
+    UNREACHABLE_ERRORS = (UserIsBlockedError, InputUserDeactivatedError, UserDeactivatedError)
+    # Errors that will not go away by retrying the same recipient
+    PERMANENT_ERRORS = (PeerIdInvalidError, ValueError)
+    TRANSIENT_ERRORS = (ServerError, asyncio.TimeoutError, ConnectionError)
+    
+    def __init__(self, concurrency=BROADCAST_CONCURRENCY, rate=BROADCAST_RATE,
+                 max_retries=BROADCAST_MAX_RETRIES, progress_interval=BROADCAST_PROGRESS_INTERVAL,
+                 commit_every=BROADCAST_COMMIT_EVERY):
+        self.concurrency = max(1, concurrency)
+        self.bucket = TokenBucket(rate)
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        self.commit_every = max(1, commit_every)
+        self.on_results = None
+        self.stats = {"total": 0, "sent": 0, "failed": 0, "flood_waits": 0, "retries": 0}
+        self.results = []
+        self.started = None
+    
+    async def run(self, batches, send, total=None, on_progress=None, on_batch_done=None, on_results=None):
+        """ارسال به دسته‌های دریافت‌کنندگان؛ send یک coroutine با ورودی شناسه کاربر است
+        
+        batches یک async iterable از لیست دریافت‌کنندگان است. on_batch_done پس از
+        تکمیل هر دسته با (دسته، نتایج) و on_results پس از هر commit_every ارسال با نتایج
+        ثبت‌نشده فراخوانی می‌شود.
+        """
+        self.stats["total"] = total or 0
+        self.started = time.monotonic()
+        self.on_results = on_results
+        
+        queue = asyncio.Queue()
+        workers = [asyncio.create_task(self._worker(queue, send)) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(self._report(on_progress)) if on_progress else None
+        try:
+            async for batch in batches:
+                if total is None:
+                    self.stats["total"] += len(batch)
+                for recipient in batch:
+                    queue.put_nowait(recipient)
+                await queue.join()
+                if on_batch_done:
+                    await on_batch_done(batch, self.drain_results())
+        finally:
+            for worker in workers:
+                worker.cancel()
+            if reporter:
+                reporter.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        return self.stats
+    
+    def drain_results(self):
+        """نتایج ثبت‌نشده به صورت (شناسه، وضعیت)"""
+        results, self.results = self.results, []
+        return results
+    
+    async def _worker(self, queue, send):
+        # Every FloodWaitError must reach the shared bucket, so none is slept through inside the client
+        FLOOD_SLEEP_THRESHOLD.set(0)
+        while True:
+            recipient = await queue.get()
+            try:
+                status = await self._deliver(recipient, send)
+                self.stats["sent" if status == "sent" else "failed"] += 1
+                metrics.inc("bot_broadcast_messages_total", status=status)
+                metrics.set("bot_broadcast_send_rate", self.bucket.rate)
+                self.results.append((recipient, status))
+                if self.on_results and len(self.results) >= self.commit_every:
+                    results = self.drain_results()
+                    try:
+                        await self.on_results(results)
+                    except Exception as e:
+                        # Kept for the next commit; a dead worker would leave queue.join() waiting forever
+                        logger.error(f"Error recording broadcast deliveries, will retry: {e}")
+                        self.results = results + self.results
+            finally:
+                queue.task_done()
+    
+    async def _deliver(self, recipient, send):
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await send(recipient)
+                self.bucket.reward()
+                return "sent"
+            except FloodWaitError as e:
+                self.stats["flood_waits"] += 1
+                metrics.inc("bot_broadcast_flood_waits_total")
+                logger.warning(f"Flood wait of {e.seconds}s during broadcast, slowing down to {self.bucket.rate / 2:.1f} msg/s")
+                self.bucket.penalize(e.seconds)
+            except self.UNREACHABLE_ERRORS as e:
+                logger.info(f"Skipping {recipient}: {e}")
+                return "blocked"
+            except self.PERMANENT_ERRORS as e:
+                logger.info(f"Skipping {recipient}: {e}")
+                return "failed"
+            except self.TRANSIENT_ERRORS as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.error(f"error sending message to {recipient} after {attempt} attempts: {e}")
+                    return "failed"
+                self.stats["retries"] += 1
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logger.error(f"error sending message to {recipient}: {e}")
+                return "failed"
+    
+    async def _report(self, on_progress):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            try:
+                await on_progress(self.progress())
+            except Exception as e:
+                logger.warning(f"Error reporting broadcast progress: {e}")
+    
+    def progress(self):
+        """وضعیت فعلی ارسال شامل نرخ و زمان باقی‌مانده"""
+        done = self.stats["sent"] + self.stats["failed"]
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        rate = done / elapsed
+        remaining = self.stats["total"] - done
+        eta = remaining / rate if rate > 0 else None
+        return dict(self.stats, done=done, rate=rate, eta=eta, elapsed=elapsed)
+
+
+def format_broadcast_progress(progress):
+    """متن وضعیت پیشرفت ارسال گروهی"""
+    eta = f"{int(progress['eta'] // 60)} دقیقه و {int(progress['eta'] % 60)} ثانیه" if progress['eta'] is not None else "نامشخص"
+    return f"""🔄 در حال ارسال پیام به کاربران...
+
+• پیشرفت: {progress['done']} از {progress['total']} نفر
+• ارسال موفق: {progress['sent']} نفر
+• ارسال ناموفق: {progress['failed']} نفر
+• سرعت: {progress['rate']:.1f} پیام در ثانیه
+• زمان باقی‌مانده: {eta}"""
+
+# (sheet/file name, table, indexed epoch column used by the date-range filter)
+REPORT_TABLES = [
+    ("Users", "users", "last_activity_ts"),
+    ("Activities", "user_activity", "ts"),
+    ("Broadcasts", "message_broadcasts", "sent_ts"),
+]
+REPORT_FORMATS = {"xlsx": "Excel", "csv": "CSV.gz", "parquet": "Parquet"}
+REPORT_RANGES = {"1": "۲۴ ساعت اخیر", "7": "۷ روز اخیر", "30": "۳۰ روز اخیر", "all": "همه", "delta": "تغییرات از گزارش قبلی"}
+# table -> column whose high-watermark marks what an admin has already exported
+REPORT_WATERMARKS = {"users": "last_activity_ts", "user_activity": "id", "message_broadcasts": "id"}
+EXCEL_MAX_ROWS = 1048576
+
+
+def _iter_report_rows(conn, table, where):
+    """خواندن سطرهای یک جدول به صورت تکه‌تکه؛ where یک (شرط، پارامترها) یا None است"""
+    cur = conn.cursor()
+    if where:
+        cur.execute(f"SELECT * FROM {table} WHERE {where[0]}", where[1])
+    else:
+        cur.execute(f"SELECT * FROM {table}")
+    columns = [column[0] for column in cur.description]
+    
+    def chunks():
+        while True:
+            rows = cur.fetchmany(REPORT_CHUNK_SIZE)
+            if not rows:
+                return
+            yield rows
+    return columns, chunks()
+
+
+def _report_filters(conn, since=None, watermarks=None):
+    """شرط هر جدول برای بازه زمانی یا، در حالت تغییرات، بین watermark قبلی و جدید"""
+    filters, marks = {}, {}
+    for _, table, time_column in REPORT_TABLES:
+        if watermarks is not None:
+            column = REPORT_WATERMARKS[table]
+            low = watermarks.get(table, 0)
+            high = conn.execute(f"SELECT MAX({column}) FROM {table}").fetchone()[0] or 0
+            if column == "last_activity_ts":
+                # Activity reaches the table up to a flush interval late; recent seconds wait for the next export
+                high = min(high, int(time.time()) - int(ACTIVITY_FLUSH_INTERVAL) - 1)
+            marks[table] = max(low, high)
+            # Bounded above so the next export starts exactly where this one stopped
+            filters[table] = (f"{column} > ? AND {column} <= ?", (low, marks[table]))
+        elif since:
+            filters[table] = (f"{time_column} >= ?", (since,))
+    return filters, marks
+
+
+def _write_xlsx(conn, directory, filters):
+    path = os.path.join(directory, "bot_report.xlsx")
+    # constant_memory flushes each row to disk as soon as it is written
+    xlsxwriter = lazy_import("xlsxwriter")
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    try:
+        for sheet_name, table, _ in REPORT_TABLES:
+            columns, chunks = _iter_report_rows(conn, table, filters.get(table))
+            part = 1
+            sheet = workbook.add_worksheet(sheet_name)
+            sheet.write_row(0, 0, columns)
+            row_index = 1
+            for rows in chunks:
+                for row in rows:
+                    if row_index == EXCEL_MAX_ROWS:
+                        part += 1
+                        sheet = workbook.add_worksheet(f"{sheet_name} ({part})")
+                        sheet.write_row(0, 0, columns)
+                        row_index = 1
+                    sheet.write_row(row_index, 0, row)
+                    row_index += 1
+    finally:
+        workbook.close()
+    return [path]
+
+
+def _write_csv(conn, directory, filters):
+    paths = []
+    for name, table, _ in REPORT_TABLES:
+        path = os.path.join(directory, f"{table}.csv.gz")
+        columns, chunks = _iter_report_rows(conn, table, filters.get(table))
+        with gzip.open(path, "wt", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for rows in chunks:
+                writer.writerows(rows)
+        paths.append(path)
+    return paths
+
+
+def _write_parquet(conn, directory, filters):
+    pa = lazy_import("pyarrow")
+    pq = lazy_import("pyarrow.parquet")
+    paths = []
+    for name, table, _ in REPORT_TABLES:
+        path = os.path.join(directory, f"{table}.parquet")
+        # Declared column types give a stable schema even when a chunk is all NULL
+        declared = conn.execute(f"PRAGMA table_info({table})").fetchall()
+        schema = pa.schema([
+            (column[1], pa.int64() if column[2].upper() in ("INTEGER", "BOOLEAN") else pa.string())
+            for column in declared
+        ])
+        columns, chunks = _iter_report_rows(conn, table, filters.get(table))
+        with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+            for rows in chunks:
+                writer.write_table(pa.Table.from_pylist([dict(zip(columns, row)) for row in rows], schema=schema))
+        paths.append(path)
+    return paths
+
+
+REPORT_WRITERS = {"xlsx": _write_xlsx, "csv": _write_csv, "parquet": _write_parquet}
+
+
+def export_report(db_file, report_format, days=None, watermarks=None):
+    """ساخت فایل‌های گزارش در یک پوشه موقت؛ برای اجرا خارج از حلقه رویداد
+    
+    با watermarks فقط سطرهای جدیدتر خروجی گرفته می‌شوند و (پوشه، فایل‌ها، delta) بازگردانده
+    می‌شود که delta شامل watermark های جدید، تعداد سطرهای هر جدول و بخش‌های بایگانی است.
+    """
+    since = int(time.time()) - days * 86400 if days else None
+    directory = tempfile.mkdtemp(prefix="bot_report_")
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    try:
+        # One read transaction, so the watermarks, the report and the archive parts come from the same snapshot
+        conn.execute("BEGIN")
+        filters, marks = _report_filters(conn, since, watermarks)
+        delta = None
+        if watermarks is not None:
+            counts = {
+                table: conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {where[0]}", where[1]).fetchone()[0]
+                for table, where in filters.items()
+            }
+            delta = {"watermarks": marks, "counts": counts}
+            if not any(counts.values()):
+                return directory, [], delta
+            delta["archive"] = _write_archive_parts(conn, directory, filters)
+        return directory, REPORT_WRITERS[report_format](conn, directory, filters), delta
+    except Exception:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    finally:
+        conn.close()
+
+
+def _write_archive_parts(conn, directory, filters):
+    """سطرهای تغییرات هر جدول بدون سطر عنوان، برای افزودن به بایگانی پس از ارسال گزارش"""
+    os.makedirs(os.path.join(directory, "archive"))
+    parts = {}
+    for _, table, _ in REPORT_TABLES:
+        path = os.path.join(directory, "archive", f"{table}.csv.gz")
+        columns, chunks = _iter_report_rows(conn, table, filters.get(table))
+        with gzip.open(path, "wt", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            for rows in chunks:
+                writer.writerows(rows)
+        parts[table] = (columns, path)
+    return parts
+
+
+def append_export_archive(admin_id, parts, archive_dir):
+    """افزودن بخش‌های تغییرات ساخته شده در export_report به فایل‌های بایگانی ماهانه ادمین"""
+    directory = os.path.join(archive_dir, "exports", str(admin_id))
+    os.makedirs(directory, exist_ok=True)
+    month = datetime.now().strftime('%Y-%m')
+    for table, (columns, part) in parts.items():
+        path = os.path.join(directory, f"{table}-{month}.csv.gz")
+        if not os.path.exists(path):
+            with gzip.open(path, "wt", newline="", encoding="utf-8") as f:
+                csv.writer(f).writerow(columns)
+        # Concatenated gzip members read back as one file; the archive grows with new activity only
+        with open(part, "rb") as src, open(path, "ab") as dst:
+            shutil.copyfileobj(src, dst)
+
+
+def get_report_format_buttons():
+    formats = [f for f in REPORT_FORMATS if f != "parquet" or HAS_PYARROW]
+    return [[Button.inline(REPORT_FORMATS[f], data=f"report:{f}") for f in formats]]
+
+
+def get_report_range_buttons(report_format):
+    return [
+        [Button.inline(label, data=f"report:{report_format}:{days}") for days, label in REPORT_RANGES.items()]
+    ]
+
+
+class AdminStateStore:
+    """نگهداری وضعیت گفتگوی ادمین‌ها با انقضای زمانی و اندازه محدود
+    
+    فقط داده‌های قابل ذخیره در JSON (مثل chat_id و message_id) نگه داشته می‌شود.
+    در حالت sqlite وضعیت‌ها پس از راه‌اندازی مجدد و بین چند پروسه حفظ می‌شوند.
+    در حافظه قدیمی‌ترین مورد استفاده و در sqlite قدیمی‌ترین مورد نوشته شده حذف می‌شود.
+    """
+    def __init__(self, maxsize=ADMIN_STATE_MAXSIZE, ttl=ADMIN_STATE_TTL, db_file=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.conn = None
+        self.executor = None
+        if db_file:
+            # users.db is also written by the DB thread and the retention task, so access runs in its own thread
+            self.conn = sqlite3.connect(db_file, check_same_thread=False)
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="admin_state")
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS admin_state (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT,
+                expires_at REAL
+            )
+            ''')
+            self.conn.commit()
+    
+    async def _call(self, func, *args):
+        if self.conn is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+    
+    async def get(self, user_id):
+        """وضعیت فعلی ادمین یا None در صورت نبود یا انقضا"""
+        return await self._call(self._get, user_id)
+    
+    async def set(self, user_id, state, **data):
+        """جایگزینی کامل وضعیت ادمین"""
+        await self._call(self._save, user_id, dict(data, state=state))
+    
+    async def update(self, user_id, **data):
+        """افزودن داده به وضعیت فعلی ادمین"""
+        await self._call(self._update, user_id, data)
+    
+    def _get(self, user_id):
+        now = time.time()
+        if self.conn:
+            row = self.conn.execute(
+                "SELECT data FROM admin_state WHERE user_id = ? AND expires_at > ?", (user_id, now)
+            ).fetchone()
+            return json.loads(row[0]) if row else None
         
-        await event.respond(f"""آیا از ارسال این پیام به تمام کاربران اطمینان دارید؟
+        item = self.memory.get(user_id)
+        if item is None:
+            return None
+        if item[1] <= now:
+            del self.memory[user_id]
+            return None
+        # Reads count as use, so eviction drops the least recently used flow
+        self.memory.move_to_end(user_id)
+        return dict(item[0])
+    
+    def _update(self, user_id, data):
+        current = self._get(user_id) or {"state": None}
+        current.update(data)
+        self._save(user_id, current)
+    
+    def _save(self, user_id, value):
+        expires_at = time.time() + self.ttl
+        if self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO admin_state (user_id, data, expires_at) VALUES (?, ?, ?)",
+                (user_id, json.dumps(value), expires_at)
+            )
+            self.conn.execute("DELETE FROM admin_state WHERE expires_at <= ?", (time.time(),))
+            self.conn.execute(
+                "DELETE FROM admin_state WHERE user_id NOT IN (SELECT user_id FROM admin_state ORDER BY expires_at DESC LIMIT ?)",
+                (self.maxsize,)
+            )
+            self.conn.commit()
+            return
+        
+        self.memory[user_id] = (value, expires_at)
+        self.memory.move_to_end(user_id)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+    
+    def close(self):
+        if self.conn:
+            self.executor.submit(self.conn.close).result()
+            self.executor.shutdown()
+
+
+admin_states = AdminStateStore(db_file=db.db_file if ADMIN_STATE_BACKEND == "sqlite" else None)
+
+# Admin conversation states
+STATE_MAIN_MENU = "main_menu"
+STATE_STATS = "stats"
+STATE_CHOOSING_BROADCAST_TYPE = "broadcast_message"
+STATE_WAITING_FOR_BROADCAST = "waiting_for_broadcast_message"
+
+
+def get_admin_keyboard():
+    return [
+        [Button.text("📊 آمار کاربران"), Button.text("📤 ارسال پیام به همه")],
+        [Button.text("📋 گزارش فعالیت‌ها"), Button.text("⚙️ تنظیمات")],
+        [Button.text("🧾 وضعیت کارها"), Button.text("⚡️ عملکرد")],
+        [Button.text("📈 تحلیل رشد"), Button.text("🔬 پروفایل")],
+        [Button.text("🔙 بازگشت به منوی اصلی")]
+    ]
+
+
+async def set_admin_state(user_id, state, **data):
+    await admin_states.set(user_id, state, **data)
+
+
+@timed_handler
+async def admin_panel(event):
+    """پنل ادمین برای مدیریت ربات"""
+    user_id = event.sender_id
+    
+    if not is_admin(user_id):
+        await event.respond("شما دسترسی به این بخش را ندارید.")
+        return
+    
+    await set_admin_state(user_id, STATE_MAIN_MENU)
+    await event.respond("🔐 به پنل مدیریت خوش آمدید. لطفا گزینه مورد نظر را انتخاب کنید:", buttons=get_admin_keyboard())
+
+@timed_handler
+async def show_stats(event):
+    """نمایش آمار کاربران و نمودار کاربران جدید"""
+    await set_admin_state(event.sender_id, STATE_STATS)
+    stats = await db.get_user_stats()
+    
+    stats_text = f"""📊 **آمار ربات**
+
+👥 **آمار کاربران:**
+• کل کاربران: {stats['total_users']} نفر
+• کاربران فعال در 24 ساعت گذشته: {stats['active_users_24h']} نفر
+• کاربران فعال امروز: {stats['active_users_today']} نفر
+• کاربران جدید در 7 روز گذشته: {stats['new_users_7d']} نفر
+• کل دستورات اجرا شده: {stats['total_commands']}
+
+🔝 **فعالیت‌های پرکاربرد:**
+"""
+    for activity, count in stats["activity_stats"][:5]:
+        stats_text += f"• {activity}: {count} بار\n"
+    
+    await event.respond(stats_text)
+    
+    # The chart is rendered by the job worker and sent when ready
+    if stats["daily_new_users"]:
+        await jobs.enqueue("chart", event.sender_id, days=7)
+
+@timed_handler
+async def start_broadcast(event):
+    """شروع ارسال پیام گروهی و انتخاب نوع ارسال"""
+    await set_admin_state(event.sender_id, STATE_CHOOSING_BROADCAST_TYPE)
+    
+    broadcast_buttons = [
+        [Button.text("🔄 ارسال با نام (Forward)"), Button.text("📋 ارسال بدون نام (Copy)")],
+        [Button.text("🔙 بازگشت")]
+    ]
+    
+    await event.respond("""🔄 **ارسال پیام به همه کاربران**
+
+لطفا نوع ارسال را انتخاب کنید:
+- **ارسال با نام (Forward)**: پیام با نام شما ارسال می‌شود
+- **ارسال بدون نام (Copy)**: پیام بدون نام ارسال می‌شود
+
+سپس پیام خود را ارسال کنید.""", buttons=broadcast_buttons)
+
+@timed_handler
+async def show_report_formats(event):
+    """نمایش فرمت‌های گزارش فعالیت‌ها"""
+    await event.respond("📋 فرمت گزارش را انتخاب کنید:", buttons=get_report_format_buttons())
+
+JOB_KIND_LABELS = {"report": "گزارش", "chart": "نمودار", "broadcast": "ارسال گروهی", "analytics": "تحلیل رشد"}
+JOB_STATUS_LABELS = {"queued": "⏳ در صف", "running": "🔄 در حال اجرا", "done": "✅ انجام شد", "failed": "❌ ناموفق"}
+
+@timed_handler
+async def show_jobs(event):
+    """نمایش وضعیت آخرین کارهای صف"""
+    recent_jobs = await jobs.recent()
+    if not recent_jobs:
+        await event.respond("🧾 هنوز کاری ثبت نشده است.")
+        return
+    
+    lines = ["🧾 **آخرین کارها:**\n"]
+    for job in recent_jobs:
+        created = datetime.fromtimestamp(job["created_at"]).strftime('%Y-%m-%d %H:%M')
+        line = f"• #{job['id']} {JOB_KIND_LABELS.get(job['kind'], job['kind'])} - {JOB_STATUS_LABELS.get(job['status'], job['status'])} ({created})"
+        if job["started_at"] and job["finished_at"]:
+            line += f" - {job['finished_at'] - job['started_at']:.1f} ثانیه"
+        lines.append(line)
+    await event.respond("\n".join(lines))
+
+class SamplingProfiler:
+    """پروفایلر نمونه‌برداری که پشته همه thread ها و task های asyncio را در فواصل ثابت ثبت می‌کند"""
+    # Leaf frames in these files mean the thread is idle (selector poll, executor queue, lock wait)
+    IDLE_FILES = ("selectors.py", "threading.py", "thread.py", "queue.py")
+    
+    def __init__(self, loop, interval=PROFILER_INTERVAL):
+        self.loop = loop
+        self.interval = interval
+        self.running = False
+        # Created from the loop's thread; used to tell its samples apart
+        self.loop_thread_id = threading.get_ident()
+        # Private asyncio map of loop -> running task; without it only the await view is available
+        self.current_tasks = getattr(asyncio.tasks, "_current_tasks", {})
+    
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    
+    def _thread_stack(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(self._frame_label(frame))
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+    
+    def _await_stacks(self):
+        """زنجیره await هر task معلق؛ زمان انتظار handler ها برای پایگاه داده و API"""
+        stacks = []
+        try:
+            tasks = asyncio.all_tasks(self.loop)
+        except RuntimeError:
+            return stacks
+        current = self.current_tasks.get(self.loop)
+        for task in tasks:
+            if task is current or task.done():
+                continue
+            stack = [f"[await] {getattr(task.get_coro(), '__qualname__', 'task')}"]
+            awaitable = task.get_coro()
+            try:
+                # Reading another thread's suspended coroutines is racy; a torn chain just ends early
+                while awaitable is not None and len(stack) < 64:
+                    frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "ag_frame", None) or getattr(awaitable, "gi_frame", None)
+                    if frame is None:
+                        # The innermost awaitable, e.g. the future of an executor or network call
+                        stack.append(f"<{type(awaitable).__name__}>")
+                        break
+                    stack.append(self._frame_label(frame))
+                    awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "ag_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+            except Exception:
+                continue
+            stacks.append(stack)
+        return stacks
+    
+    def run(self, duration):
+        """نمونه‌برداری به مدت duration ثانیه؛ در یک thread جداگانه اجرا می‌شود"""
+        self.running = True
+        samples = Counter()
+        own_id = threading.get_ident()
+        deadline = time.perf_counter() + duration
+        sample_count = 0
+        try:
+            while time.perf_counter() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    stack = self._thread_stack(frame)
+                    if thread_id == self.loop_thread_id:
+                        task = self.current_tasks.get(self.loop)
+                        if task is not None:
+                            # Attribute on-CPU loop time to the task being stepped
+                            stack.insert(0, f"[task] {task.get_coro().__qualname__}")
+                    samples[(names.get(thread_id, str(thread_id)),) + tuple(stack)] += 1
+                for stack in self._await_stacks():
+                    samples[("asyncio-await",) + tuple(stack)] += 1
+                sample_count += 1
+                time.sleep(self.interval)
+        finally:
+            self.running = False
+        return samples, sample_count
+    
+    def collapsed(self, samples):
+        """خروجی collapsed stack برای flamegraph.pl و speedscope"""
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in samples.most_common())
+    
+    def top_frames(self, samples, limit=10):
+        """پرمصرف‌ترین توابع برگ، بدون احتساب thread های بیکار"""
+        leaves = Counter()
+        for stack, count in samples.items():
+            if stack[0] == "asyncio-await":
+                continue
+            leaf = stack[-1]
+            if not leaf.split("(")[-1].startswith(self.IDLE_FILES):
+                leaves[f"{stack[0]}: {leaf}"] += count
+        return leaves.most_common(limit)
+
+
+PROFILE_DURATIONS = {10: "10 ثانیه", 30: "30 ثانیه", 60: "1 دقیقه"}
+profiler = None
+
+
+def get_profile_duration_buttons():
+    return [[Button.inline(label, data=f"profile:{seconds}") for seconds, label in PROFILE_DURATIONS.items()]]
+
+@timed_handler
+async def show_analytics(event):
+    """درخواست گزارش تحلیل رشد از worker"""
+    if not HAS_NUMPY:
+        await event.respond("⚠️ برای تحلیل رشد باید کتابخانه NumPy نصب باشد.")
+        return
+    # Make buffered activity visible to the worker
+    await db.flush_activity()
+    job_id = await jobs.enqueue("analytics", event.sender_id)
+    await event.respond(f"⏳ تحلیل رشد در صف قرار گرفت (کار #{job_id}). پس از آماده شدن ارسال می‌شود.")
+
+@timed_handler
+async def show_profiler(event):
+    """انتخاب مدت نمونه‌برداری پروفایلر"""
+    await event.respond("🔬 مدت زمان پروفایل‌گیری از ربات را انتخاب کنید:", buttons=get_profile_duration_buttons())
+
+def format_latency_rows(series, limit=8):
+    """خلاصه هیستوگرام‌ها به صورت تعداد، میانگین و صدک 95 به میلی‌ثانیه"""
+    rows = sorted(series.items(), key=lambda item: item[1][-2], reverse=True)[:limit]
+    lines = []
+    for key, data in rows:
+        label = ",".join(str(value) for _, value in key)
+        p95 = metrics.quantile(data, 0.95)
+        p95_text = f"{p95 * 1000:.0f}" if p95 != float("inf") else f">{metrics.BUCKETS[-1] * 1000:.0f}"
+        lines.append(f"• {label}: {data[-1]} بار، میانگین {data[-2] / data[-1] * 1000:.1f}، p95 ≤ {p95_text} ms")
+    return lines
+
+@timed_handler
+async def show_performance(event):
+    """خلاصه metrics پروسه ربات"""
+    lines = [f"⚡️ **عملکرد ربات** (از {int(time.time() - metrics.started)} ثانیه پیش)\n"]
+    
+    lines.append("**هندلرها:**")
+    lines.extend(format_latency_rows(metrics.histograms.get("bot_handler_seconds", {})) or ["• داده‌ای نیست"])
+    
+    lines.append("\n**پایگاه داده (زمان اجرا):**")
+    lines.extend(format_latency_rows(metrics.histograms.get("bot_db_query_seconds", {})) or ["• داده‌ای نیست"])
+    
+    lag = metrics.gauges.get("bot_event_loop_lag_last_seconds", {}).get((), 0)
+    lag_max = metrics.gauges.get("bot_event_loop_lag_max_seconds", {}).get((), 0)
+    lines.append(f"\n**تاخیر event loop:** فعلی {lag * 1000:.1f} ms، بیشینه {lag_max * 1000:.1f} ms")
+    
+    api_calls = sum(metrics.counters.get("bot_telegram_api_calls_total", {}).values())
+    api_errors = sum(metrics.counters.get("bot_telegram_api_errors_total", {}).values())
+    lines.append(f"**درخواست‌های API تلگرام:** {api_calls} (خطا: {api_errors})")
+    index = known_users.stats()
+    lines.append(f"**ایندکس کاربران:** {index['users']} کاربر، {index['bytes'] / 1024:.0f} KB، نرخ hit {index['hit_rate'] * 100:.1f}%")
+    cache = entity_cache.stats()
+    lines.append(f"**کش چت‌ها:** {cache['size']} مورد، نرخ hit {cache['hit_rate'] * 100:.1f}% ({cache['hits']}/{cache['hits'] + cache['misses']})، درخواست‌های get_entity {peer_resolver.api_calls}")
+    waits = metrics.histograms.get("bot_scheduler_wait_seconds", {})
+    wait_text = "، ".join(f"{key[0][1]} p95 ≤ {metrics.quantile(data, 0.95) * 1000:.0f} ms" for key, data in sorted(waits.items()))
+    lines.append(f"**صف به‌روزرسانی‌ها:** عمق {scheduler.queue.qsize()}/{scheduler.queue.maxsize}، ادغام‌شده {scheduler.coalesced}، رد شده {scheduler.dropped}" + (f"، انتظار {wait_text}" if wait_text else ""))
+    lines.append(f"**درخواست‌های محدود شده:** {user_throttle.shed} (کاربران در حافظه: {len(user_throttle.buckets)})")
+    
+    if METRICS_PORT:
+        lines.append(f"\nجزئیات کامل و metrics پروسه worker (ارسال گروهی و کارها): http://{METRICS_HOST}:{METRICS_PORT}/metrics و پورت {METRICS_PORT + 1}")
+    await event.respond("\n".join(lines))
+
+@timed_handler
+async def show_settings(event):
+    """بخش تنظیمات"""
+    await event.respond("⚙️ بخش تنظیمات به زودی اضافه خواهد شد.")
+
+@timed_handler
+async def back_to_main_menu(event):
+    """خروج از پنل ادمین و بازگشت به منوی اصلی"""
+    await set_admin_state(event.sender_id, None)
+    await event.respond("انتخاب کنید:", buttons=get_main_keyboard())
+
+@timed_handler
+async def back_to_admin_panel(event):
+    """بازگشت از ارسال گروهی به پنل ادمین"""
+    await set_admin_state(event.sender_id, STATE_MAIN_MENU)
+    await event.respond("🔐 به پنل مدیریت خوش آمدید. لطفا گزینه مورد نظر را انتخاب کنید:", buttons=get_admin_keyboard())
+
+@timed_handler
+async def choose_broadcast_type(event):
+    """مدیریت انتخاب نوع ارسال پیام گروهی"""
+    broadcast_type = "forward" if event.raw_text == "🔄 ارسال با نام (Forward)" else "copy"
+    await set_admin_state(event.sender_id, STATE_WAITING_FOR_BROADCAST, type=broadcast_type)
+    await event.respond("✅ لطفا پیامی که می‌خواهید به همه کاربران ارسال شود را ارسال کنید:")
+
+@timed_handler
+async def receive_broadcast_message(event):
+    """دریافت پیام برای ارسال گروهی"""
+    user_id = event.sender_id
+    broadcast_type = (await admin_states.get(user_id)).get("type")
+    message = event.message
+    
+    confirm_buttons = [
+        [Button.inline("✅ بله، ارسال شود", data="confirm_broadcast")],
+        [Button.inline("❌ خیر، لغو شود", data="cancel_broadcast")]
+    ]
+    
+    # Only a reference is kept; the message is fetched again when the broadcast starts
+    await admin_states.update(user_id, message_chat_id=message.chat_id, message_id=message.id)
+    
+    await event.respond(f"""آیا از ارسال این پیام به تمام کاربران اطمینان دارید؟
         
 نوع ارسال: {'با نام (Forward)' if broadcast_type == 'forward' else 'بدون نام (Copy)'}
 
-تعداد کاربران دریافت کننده: {len(db.get_all_users())} نفر""", buttons=confirm_buttons)
+تعداد کاربران دریافت کننده: {await db.count_active_users()} نفر""", buttons=confirm_buttons)
+
+
+COMMAND_HANDLERS = {
+    "/start": start_handler,
+    "/panel": admin_panel,
+}
+
+ADMIN_BUTTON_ACTIONS = {
+    "📊 آمار کاربران": show_stats,
+    "📤 ارسال پیام به همه": start_broadcast,
+    "📋 گزارش فعالیت‌ها": show_report_formats,
+    "⚙️ تنظیمات": show_settings,
+    "🧾 وضعیت کارها": show_jobs,
+    "⚡️ عملکرد": show_performance,
+    "📈 تحلیل رشد": show_analytics,
+    "🔬 پروفایل": show_profiler,
+    "🔙 بازگشت به منوی اصلی": back_to_main_menu,
+    "🔄 ارسال با نام (Forward)": choose_broadcast_type,
+    "📋 ارسال بدون نام (Copy)": choose_broadcast_type,
+    "🔙 بازگشت": back_to_admin_panel,
+}
+
+# Free-form messages from an admin are routed by the admin's current state
+ADMIN_STATE_HANDLERS = {
+    STATE_WAITING_FOR_BROADCAST: receive_broadcast_message,
+}
+
+@scheduled(events.NewMessage(incoming=True), message_priority, admit_message)
+@timed_handler
+async def dispatch(event):
+    """مسیریابی هر پیام به handler مربوطه با یک بار دسته‌بندی"""
+    text = event.raw_text
+    user_id = event.sender_id
+    if text.startswith("/"):
+        command = COMMAND_HANDLERS.get(command_name(text))
+        if command:
+            # Floods are shed here, before they cost a DB write or an API call
+            # Normally checked in admit_message already; this covers direct calls
+            if getattr(event, "throttle_checked", False) or not throttled(user_id, "command"):
+                await command(event)
+            return
+        # Unknown "/..." text falls through: an admin's broadcast message may start with "/"
+    
+    # Everything below is admin-only; regular users stop at this lookup
+    if user_id not in ADMIN_IDS or not event.is_private:
+        return
+    
+    action = ADMIN_BUTTON_ACTIONS.get(text)
+    if action:
+        await action(event)
         return
-@bot.on(events.CallbackQuery(pattern=r"confirm_broadcast|cancel_broadcast"))
+    
+    state = await admin_states.get(user_id)
+    handler = ADMIN_STATE_HANDLERS.get(state and state.get("state"))
+    if handler:
+        await handler(event)
+
+@scheduled(events.CallbackQuery(pattern=r"confirm_broadcast|cancel_broadcast"), PRIORITY_ADMIN)
+@timed_handler
 async def broadcast_confirmation(event):
     """مدیریت دکمه‌های تایید/لغو ارسال گروهی"""
     user_id = event.sender_id
@@ -523,76 +2449,654 @@ async def broadcast_confirmation(event):
         await event.answer("شما دسترسی ادمین ندارید", alert=True)
         return
         
-    if user_id not in ADMIN_STATE:
+    state = await admin_states.get(user_id)
+    if state is None:
         await event.answer("خطا در پردازش درخواست", alert=True)
         return
     
     data = event.data.decode("utf-8")
     
     if data == "confirm_broadcast":
-        message = ADMIN_STATE[user_id].get("message")
-        broadcast_type = ADMIN_STATE[user_id].get("type")
-        users = db.get_all_users()
+        broadcast_type = state.get("type")
+        message = None
+        if state.get("message_id"):
+            message = await bot.get_messages(state["message_chat_id"], ids=state["message_id"])
         
-        if not message or not broadcast_type or not users:
+        if not message or not broadcast_type or not await db.count_active_users():
             await event.answer("خطا در ارسال پیام", alert=True)
             return
         
         status_message = await event.respond("🔄 در حال ارسال پیام به کاربران...")
-        
-        successful_sends = 0
-        
-        for user in users:
-            try:
-                if broadcast_type == "forward":
-                    await bot.forward_messages(user, message)
-                else:  # copy mode
-                    message_text = message.message if message.message else ""
-                    if message.media:
-                        await bot.send_message(user, message_text, file=message.media)
-                    else:
-                        await bot.send_message(user, message_text)
-                successful_sends += 1
-                await asyncio.sleep(0.1) 
-            except Exception as e:
-                logger.error(f"error sending message to {user}: {e}")
-        
-        db.log_broadcast(
-            user_id, 
-            message.message, 
-            broadcast_type, 
-            len(users), 
-            successful_sends
+        job_id = await db.create_broadcast_job(
+            user_id,
+            message.chat_id,
+            message.id,
+            status_message.id,
+            message.message,
+            broadcast_type
         )
+        await set_admin_state(user_id, STATE_MAIN_MENU)
         
-        await status_message.edit(f"""✅ ارسال پیام به کاربران به پایان رسید
-
-• تعداد کل کاربران: {len(users)} نفر
-• ارسال موفق: {successful_sends} نفر
-• ارسال ناموفق: {len(users) - successful_sends} نفر""")
-        
-        ADMIN_STATE[user_id] = {"state": "main_menu"}
+        await jobs.enqueue("broadcast", user_id, dedupe_key=f"broadcast:{job_id}", broadcast_job_id=job_id)
         return
     
     elif data == "cancel_broadcast":
         await event.edit("❌ ارسال پیام لغو شد.")
-        ADMIN_STATE[user_id] = {"state": "main_menu"}
+        await set_admin_state(user_id, STATE_MAIN_MENU)
         return
 
+@scheduled(events.CallbackQuery(pattern=r"chart:"), PRIORITY_HEAVY)
+@timed_handler
+async def chart_callback(event):
+    """ارسال نمودار کاربران جدید برای بازه زمانی انتخاب شده"""
+    user_id = event.sender_id
+    
+    if not is_admin(user_id):
+        await event.answer("شما دسترسی ادمین ندارید", alert=True)
+        return
+    
+    try:
+        days = int(event.data.decode("utf-8").split(":")[1])
+    except (UnicodeDecodeError, ValueError, IndexError):
+        days = None
+    if days not in CHART_RANGES:
+        await event.answer("خطا در پردازش درخواست", alert=True)
+        return
+    
+    await jobs.enqueue("chart", user_id, days=days)
+    await event.answer("⏳ نمودار در حال آماده‌سازی است...")
+
+@scheduled(events.CallbackQuery(pattern=r"profile:"), PRIORITY_HEAVY)
+@timed_handler
+async def profile_callback(event):
+    """پروفایل‌گیری از پروسه در حال اجرا و ارسال فایل collapsed stack"""
+    global profiler
+    user_id = event.sender_id
+    
+    if not is_admin(user_id):
+        await event.answer("شما دسترسی ادمین ندارید", alert=True)
+        return
+    
+    try:
+        seconds = int(event.data.decode("utf-8").split(":")[1])
+    except (UnicodeDecodeError, ValueError, IndexError):
+        seconds = None
+    if seconds not in PROFILE_DURATIONS:
+        await event.answer("خطا در پردازش درخواست", alert=True)
+        return
+    
+    if profiler and profiler.running:
+        await event.answer("یک پروفایل در حال اجراست، لطفا صبر کنید.", alert=True)
+        return
+    
+    loop = asyncio.get_running_loop()
+    profiler = SamplingProfiler(loop)
+    await event.edit(f"🔬 در حال پروفایل‌گیری به مدت {PROFILE_DURATIONS[seconds]}...")
+    # Sampling runs on its own thread so it also sees the event loop while it is busy
+    samples, sample_count = await loop.run_in_executor(None, profiler.run, seconds)
+    
+    lines = [f"🔬 **نتیجه پروفایل** ({sample_count} نمونه در {PROFILE_DURATIONS[seconds]})\n", "**پرمصرف‌ترین توابع:**"]
+    for frame, count in profiler.top_frames(samples):
+        lines.append(f"• `{frame}`: {count * 100 / max(sample_count, 1):.1f}%")
+    if len(lines) == 2:
+        lines.append("• همه thread ها بیکار بودند")
+    
+    report = io.BytesIO(profiler.collapsed(samples).encode("utf-8"))
+    report.name = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+    await bot.send_message(user_id, "\n".join(lines), file=report)
+
+@scheduled(events.CallbackQuery(pattern=r"report:"), PRIORITY_HEAVY)
+@timed_handler
+async def report_callback(event):
+    """انتخاب فرمت و بازه زمانی و ارسال گزارش فعالیت‌ها"""
+    user_id = event.sender_id
+    
+    if not is_admin(user_id):
+        await event.answer("شما دسترسی ادمین ندارید", alert=True)
+        return
+    
+    parts = event.data.decode("utf-8").split(":")
+    report_format = parts[1]
+    if report_format not in REPORT_FORMATS:
+        await event.answer("خطا در پردازش درخواست", alert=True)
+        return
+    
+    if len(parts) == 2:
+        await event.edit(f"📋 گزارش {REPORT_FORMATS[report_format]} - بازه زمانی را انتخاب کنید:",
+                         buttons=get_report_range_buttons(report_format))
+        return
+    
+    if parts[2] not in REPORT_RANGES:
+        await event.answer("خطا در پردازش درخواست", alert=True)
+        return
+    days = None if parts[2] in ("all", "delta") else int(parts[2])
+    # Make buffered activity visible to the worker's export
+    await db.flush_activity()
+    job_id = await jobs.enqueue("report", user_id, format=report_format, range=parts[2], days=days)
+    await event.edit(f"⏳ گزارش در صف قرار گرفت (کار #{job_id}). پس از آماده شدن ارسال می‌شود.")
+
+
+async def run_broadcast_job(job_id):
+    """اجرا یا ادامه یک کار ارسال گروهی از آخرین نقطه بازیابی"""
+    job = await db.get_broadcast_job(job_id)
+    message = await bot.get_messages(job["source_chat_id"], ids=job["source_message_id"])
+    if message is None:
+        logger.error(f"Source message of broadcast job {job_id} no longer exists")
+        await db.finish_broadcast_job(job_id, "failed")
+        return
+    
+    broadcast_type = job["broadcast_type"]
+    engine = BroadcastEngine()
+    
+    message_text = message.message if message.message else ""
+    input_media = None
+    if broadcast_type != "forward" and message.media:
+        try:
+            # Converted once here instead of once per recipient inside send_message
+            input_media = utils.get_input_media(message.media)
+        except TypeError:
+            input_media = message.media
+    
+    # user_id -> InputPeerUser for the current batch, built from stored access hashes
+    peers = {}
+    
+    async def send(user):
+        peer = peers.get(user, user)
+        if broadcast_type == "forward":
+            await bot.forward_messages(peer, message)
+        elif input_media:  # copy mode
+            await bot.send_message(peer, message_text, file=input_media)
+        else:
+            await bot.send_message(peer, message_text)
+    
+    async def batches():
+        last_user_id = job["last_user_id"]
+        while True:
+            rows = await db.get_broadcast_recipients(job_id, last_user_id, BROADCAST_BATCH_SIZE)
+            if not rows:
+                return
+            # Users without a stored hash fall back to Telethon's session cache
+            peers.update((user_id, InputPeerUser(user_id, access_hash)) for user_id, access_hash in rows if access_hash is not None)
+            batch = [user_id for user_id, _ in rows]
+            yield batch
+            last_user_id = batch[-1]
+    
+    async def on_batch_done(batch, results):
+        peers.clear()
+        await db.record_broadcast_deliveries(job_id, results, last_user_id=batch[-1])
+    
+    async def on_results(results):
+        # Persist deliveries as they complete so a restart does not send them again
+        await db.record_broadcast_deliveries(job_id, results)
+    
+    async def report(progress):
+        await db.record_broadcast_deliveries(job_id, engine.drain_results())
+        progress = dict(progress)
+        progress["sent"] += job["successful_sends"]
+        progress["failed"] += job["failed_sends"]
+        progress["done"] += job["successful_sends"] + job["failed_sends"]
+        progress["total"] += job["successful_sends"] + job["failed_sends"]
+        await bot.edit_message(job["admin_id"], job["status_message_id"], format_broadcast_progress(progress))
+    
+    remaining = await db.count_broadcast_recipients(job_id, job["last_user_id"])
+    try:
+        await engine.run(batches(), send, total=remaining, on_progress=report, on_batch_done=on_batch_done,
+                         on_results=on_results)
+    finally:
+        # Also reached on shutdown; the job stays 'running' and resumes on next start
+        await db.record_broadcast_deliveries(job_id, engine.drain_results())
+    
+    await db.finish_broadcast_job(job_id)
+    job = await db.get_broadcast_job(job_id)
+    total_recipients = job["successful_sends"] + job["failed_sends"]
+    await db.log_broadcast(
+        job["admin_id"],
+        job["message_text"],
+        broadcast_type,
+        total_recipients,
+        job["successful_sends"]
+    )
+    
+    await bot.edit_message(job["admin_id"], job["status_message_id"], f"""✅ ارسال پیام به کاربران به پایان رسید
+
+• تعداد کل کاربران: {total_recipients} نفر
+• ارسال موفق: {job['successful_sends']} نفر
+• ارسال ناموفق: {job['failed_sends']} نفر""")
+
+
+async def run_report_job(job):
+    """ساخت و ارسال گزارش فعالیت‌ها"""
+    payload = job["payload"]
+    admin_id = job["admin_id"]
+    loop = asyncio.get_running_loop()
+    watermarks = await db.get_export_watermarks(admin_id) if payload["range"] == "delta" else None
+    directory, paths, delta = await loop.run_in_executor(
+        None, export_report, db.db_file, payload["format"], payload["days"], watermarks
+    )
+    try:
+        if delta and not paths:
+            await bot.send_message(admin_id, "✅ از گزارش قبلی شما تغییری ثبت نشده است.")
+            return {"files": [], "counts": delta["counts"]}
+        caption = f"📊 گزارش فعالیت‌های ربات ({REPORT_RANGES[payload['range']]})"
+        if delta:
+            counts = delta["counts"]
+            caption += f"\n• کاربران: {counts['users']}\n• فعالیت‌ها: {counts['user_activity']}\n• ارسال‌های گروهی: {counts['message_broadcasts']}"
+        await bot.send_message(admin_id, caption, file=paths)
+        if delta:
+            # Only after a successful send, so a failed report is exported again next time
+            await loop.run_in_executor(None, append_export_archive, admin_id, delta["archive"], ARCHIVE_DIR)
+            await db.set_export_watermarks(admin_id, delta["watermarks"])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    
+    if delta:
+        return {"files": [os.path.basename(path) for path in paths], "counts": delta["counts"]}
+    return {"files": [os.path.basename(path) for path in paths]}
+
+
+async def run_chart_job(job):
+    """رسم و ارسال نمودار کاربران جدید"""
+    days = job["payload"]["days"]
+    chart_buf = await create_stats_chart(await db.get_daily_new_users(days), days)
+    if not chart_buf:
+        await bot.send_message(job["admin_id"], "داده‌ای برای این بازه وجود ندارد.")
+        return {"rendered": False}
+    
+    await bot.send_message(job["admin_id"], f"📈 نمودار کاربران جدید در {CHART_RANGES[days]} گذشته",
+                           file=chart_buf, buttons=get_chart_range_buttons())
+    return {"rendered": True}
+
+
+def format_analytics(result):
+    """متن گزارش تحلیل رشد برای پنل ادمین"""
+    lines = [
+        "📈 **تحلیل رشد**\n",
+        f"• کاربران فعال روزانه (DAU): {result['dau']} نفر",
+        f"• کاربران فعال هفتگی (WAU): {result['wau']} نفر",
+        f"• کاربران فعال ماهانه (MAU): {result['mau']} نفر",
+        f"• چسبندگی (DAU/MAU): {result['stickiness'] * 100:.1f}%",
+        "\n**ماندگاری هفتگی** (درصد کاربران هر هفته عضویت که n هفته بعد فعال بوده‌اند):",
+    ]
+    # The last 8 cohorts and first 6 weeks fit a phone screen; the chart has the full matrix
+    table = ["week        users   " + " ".join(f"w{week:<3}" for week in range(6))]
+    for start, size, rates in list(zip(result["cohort_starts"], result["cohort_sizes"], result["retention"]))[-8:]:
+        cells = " ".join(f"{rate * 100:3.0f}%" if rate >= 0 else "  - " for rate in rates[:6])
+        table.append(f"{start}  {size:6d}  {cells}")
+    lines.append("```\n" + "\n".join(table) + "\n```")
+    
+    lines.append("**روند فعالیت‌ها (ماهانه):**")
+    months = result["trend_months"][-3:]
+    for kind, counts in sorted(result["trends"].items(), key=lambda item: -sum(item[1])):
+        lines.append(f"• {kind}: " + "، ".join(f"{month}: {count}" for month, count in zip(months, counts[-3:])))
+    
+    source = "از cache" if result["cached"] else f"خواندن {result['load_seconds']:.1f} و محاسبه {result['compute_seconds']:.2f} ثانیه"
+    lines.append(f"\nمحاسبه روی {result['rows']} فعالیت و {result['users']} کاربر ({source})")
+    return "\n".join(lines)
+
+
+def render_analytics_chart(result):
+    """رسم DAU روزانه و نقشه حرارتی ماندگاری؛ برای اجرا خارج از حلقه رویداد"""
+    Figure = lazy_import("matplotlib.figure").Figure
+    np = lazy_import("numpy")
+    fig = Figure(figsize=(12, 10))
+    dau_ax, retention_ax = fig.subplots(2, 1, gridspec_kw={"height_ratios": [1, 2]})
+    
+    dau_ax.plot(range(len(result["dau_series"])), result["dau_series"], color='steelblue', marker='o', markersize=3)
+    dau_ax.set_title(f'Daily active users, last {len(result["dau_series"])} days', fontsize=13)
+    dau_ax.set_ylabel('Users')
+    
+    rates = np.ma.masked_less(np.array(result["retention"]) * 100, 0)
+    image = retention_ax.imshow(rates, cmap='Blues', vmin=0, vmax=100, aspect='auto')
+    retention_ax.set_title('Weekly cohort retention (%)', fontsize=13)
+    retention_ax.set_xlabel('Weeks since joining')
+    retention_ax.set_xticks(range(rates.shape[1]))
+    retention_ax.set_yticks(range(rates.shape[0]))
+    retention_ax.set_yticklabels([f"{start} ({size})" for start, size in zip(result["cohort_starts"], result["cohort_sizes"])])
+    for (row, column), rate in np.ndenumerate(rates.filled(-1)):
+        if rate >= 0:
+            retention_ax.text(column, row, f"{rate:.0f}", ha='center', va='center', fontsize=8,
+                              color='white' if rate > 60 else 'black')
+    fig.colorbar(image, ax=retention_ax)
+    fig.tight_layout()
+    
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+
+async def run_analytics_job(job):
+    """محاسبه و ارسال شاخص‌های رشد، DAU/WAU/MAU و ماندگاری هفتگی"""
+    analytics = lazy_import("analytics")
+    loop = asyncio.get_running_loop()
+    # Cached in this process until new users or activity arrive
+    result = await loop.run_in_executor(None, analytics.report, db.db_file)
+    
+    chart_buf = None
+    if HAS_MATPLOTLIB:
+        try:
+            chart_buf = io.BytesIO(await loop.run_in_executor(None, render_analytics_chart, result))
+            chart_buf.name = "analytics.png"
+        except Exception as e:
+            logger.error(f"Error creating analytics chart: {e}")
+    
+    await bot.send_message(job["admin_id"], format_analytics(result))
+    if chart_buf:
+        # Sent separately: the report is longer than a media caption may be
+        await bot.send_message(job["admin_id"], "📈 کاربران فعال روزانه و ماندگاری هفتگی", file=chart_buf)
+    return {"cached": result["cached"], "rows": result["rows"]}
+
+
+async def run_broadcast_queue_job(job):
+    """اجرا یا ادامه یک ارسال گروهی"""
+    await run_broadcast_job(job["payload"]["broadcast_job_id"])
+
+
+JOB_HANDLERS = {
+    "report": run_report_job,
+    "chart": run_chart_job,
+    "broadcast": run_broadcast_queue_job,
+    "analytics": run_analytics_job,
+}
+
+
+async def run_job(job):
+    """اجرای یک کار و ثبت نتیجه آن در صف"""
+    logger.info(f"Running job {job['id']} ({job['kind']})")
+    started = time.perf_counter()
+    try:
+        result = await JOB_HANDLERS[job["kind"]](job)
+    except asyncio.CancelledError:
+        # A graceful stop does not count as an attempt; the job runs again when the worker restarts
+        # Shielded so the update still lands while the worker is shutting down
+        await asyncio.shield(jobs.release(job["id"]))
+        raise
+    except Exception as e:
+        metrics.inc("bot_jobs_total", kind=job["kind"], status="failed")
+        logger.error(f"Job {job['id']} ({job['kind']}) failed: {e}")
+        await jobs.fail(job["id"], str(e))
+        try:
+            await bot.send_message(job["admin_id"], f"❌ کار #{job['id']} با خطا متوقف شد. لطفا بعدا تلاش کنید.")
+        except Exception as e:
+            logger.error(f"Error notifying admin about job {job['id']}: {e}")
+        return
+    finally:
+        metrics.observe("bot_job_seconds", time.perf_counter() - started, kind=job["kind"])
+    metrics.inc("bot_jobs_total", kind=job["kind"], status="done")
+    await jobs.complete(job["id"], result)
+
+
+async def enqueue_unfinished_broadcasts():
+    """قرار دادن ارسال‌های گروهی نیمه‌تمامی که در صف نیستند"""
+    for job_id in await db.get_unfinished_broadcast_jobs():
+        admin_id = (await db.get_broadcast_job(job_id))["admin_id"]
+        # Skipped by the dedupe key if the bot (or an earlier run) already queued this broadcast
+        if await jobs.enqueue("broadcast", admin_id, dedupe_key=f"broadcast:{job_id}", broadcast_job_id=job_id):
+            logger.info(f"Queued unfinished broadcast job {job_id}")
+
+
+async def recover_jobs():
+    """بازگرداندن کارهای worker های از کار افتاده به صف و لغو کارهایی که مدام باعث توقف می‌شوند"""
+    requeued, failed = await jobs.requeue_expired(JOB_MAX_ATTEMPTS)
+    if requeued:
+        logger.info(f"Requeued {requeued} interrupted jobs")
+    for job in failed:
+        logger.error(f"Job {job['id']} ({job['kind']}) crashed the worker {job['attempts']} times, giving up")
+        if job["kind"] == "broadcast":
+            await db.finish_broadcast_job(job["payload"]["broadcast_job_id"], "failed")
+        try:
+            await bot.send_message(job["admin_id"], f"❌ کار #{job['id']} چند بار باعث توقف worker شد و لغو شد.")
+        except Exception as e:
+            logger.error(f"Error notifying admin about job {job['id']}: {e}")
+
+
+async def lease_task(worker_id):
+    """تمدید اجاره کارهای این worker و بازیابی کارهای worker های از کار افتاده"""
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            await jobs.heartbeat(worker_id, JOB_LEASE_SECONDS)
+            await recover_jobs()
+        except Exception as e:
+            logger.error(f"Error renewing job leases: {e}")
+
+
+async def job_worker(worker_id):
+    """برداشتن کارها از صف و اجرای هم‌زمان حداکثر JOB_WORKER_CONCURRENCY کار"""
+    slots = asyncio.Semaphore(JOB_WORKER_CONCURRENCY)
+    running = set()
+    
+    def done(task):
+        running.discard(task)
+        slots.release()
+    
+    try:
+        while True:
+            await slots.acquire()
+            job = await jobs.claim(worker_id, JOB_LEASE_SECONDS)
+            if job is None:
+                slots.release()
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+            task = asyncio.create_task(run_job(job))
+            running.add(task)
+            task.add_done_callback(done)
+    finally:
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+
+async def supervise_worker():
+    """اجرای پروسه worker در کنار ربات و راه‌اندازی مجدد آن در صورت توقف"""
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), "--worker")
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            process.terminate()
+            await process.wait()
+            raise
+        logger.warning(f"Job worker exited with code {code}, restarting in 5s")
+        await asyncio.sleep(5)
+
+
+async def activity_flusher():
+    """نوشتن دوره‌ای بافر فعالیت کاربران"""
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        await db.flush_activity()
+
+
+async def retention_task():
+    """اجرای دوره‌ای سیاست نگهداری جدول فعالیت‌ها در پروسه worker"""
+    if await db.auto_vacuum_mode() != 2:
+        logger.info("auto_vacuum is not INCREMENTAL; run a one-off VACUUM on the database to reclaim pruned space")
+    while True:
+        started = time.perf_counter()
+        cutoff_ts = int(time.time()) - ACTIVITY_RETENTION_DAYS * 86400
+        pruned = 0
+        try:
+            while True:
+                batch = await db.prune_activity(cutoff_ts, RETENTION_BATCH_SIZE, ARCHIVE_DIR)
+                if not batch:
+                    break
+                pruned += batch
+                await db.reclaim_space(RETENTION_BATCH_SIZE // 10)
+                # Short batches keep the write lock free for the bot process
+                await asyncio.sleep(0.1)
+        except (sqlite3.Error, OSError):
+            logger.exception("Activity retention failed")
+        if pruned:
+            logger.info(f"Archived and pruned {pruned} activity rows in {time.perf_counter() - started:.1f}s")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+
+async def loop_lag_monitor():
+    """اندازه‌گیری تاخیر event loop با مقایسه زمان واقعی بیدار شدن با زمان مورد انتظار"""
+    lag_max = 0.0
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+        lag_max = max(lag_max, lag)
+        metrics.set("bot_event_loop_lag_last_seconds", lag)
+        metrics.set("bot_event_loop_lag_max_seconds", lag_max)
+        metrics.observe("bot_event_loop_lag_seconds", lag)
+
+
+async def serve_metrics(host, port):
+    """ارائه metrics در مسیر /metrics با یک سرور HTTP ساده"""
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Drain the headers; the request body is never used
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                metrics.set("bot_activity_buffer_size", len(db.database.activity_buffer))
+                flush_stats = db.database.flush_stats
+                metrics.set("bot_activity_flushes", flush_stats["flushes"])
+                metrics.set("bot_activity_flush_last_seconds", flush_stats["last_latency"])
+                metrics.set("bot_activity_flush_failures", flush_stats["failures"])
+                metrics.set("bot_activity_dropped_events", flush_stats["dropped"])
+                metrics.set("bot_throttle_tracked_users", len(user_throttle.buckets))
+                index = known_users.stats()
+                metrics.set("bot_known_users", index["users"])
+                metrics.set("bot_known_users_bytes", index["bytes"])
+                metrics.set("bot_known_users_hits", index["hits"])
+                metrics.set("bot_known_users_misses", index["misses"])
+                cache = entity_cache.stats()
+                metrics.set("bot_entity_cache_size", cache["size"])
+                metrics.set("bot_entity_cache_hits", cache["hits"])
+                metrics.set("bot_entity_cache_misses", cache["misses"])
+                metrics.set("bot_peer_resolver_api_calls", peer_resolver.api_calls)
+                status, body = "200 OK", metrics.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+async def start_instrumentation(port):
+    """راه‌اندازی پایش تاخیر event loop و endpoint متریک‌ها"""
+    tasks = [asyncio.create_task(loop_lag_monitor())]
+    server = None
+    if port:
+        try:
+            server = await serve_metrics(METRICS_HOST, port)
+        except OSError as e:
+            logger.error(f"Could not start metrics endpoint on port {port}: {e}")
+    return tasks, server
+
+
+async def stop_instrumentation(tasks, server):
+    """توقف پایش و بستن endpoint متریک‌ها"""
+    for task in tasks:
+        task.cancel()
+    if server:
+        server.close()
+        await server.wait_closed()
+
+
+STARTUP_METRICS = {"import_seconds": STARTUP_IMPORTED - STARTUP_STARTED}
+
+
+def log_startup_time():
+    """ثبت مدت زمان راه‌اندازی و حافظه مصرفی ربات"""
+    STARTUP_METRICS["ready_seconds"] = time.perf_counter() - STARTUP_STARTED
+    if resource:
+        # ru_maxrss is reported in kilobytes on Linux
+        STARTUP_METRICS["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    logger.info(
+        f"Startup took {STARTUP_METRICS['ready_seconds']:.2f}s "
+        f"(imports and setup {STARTUP_METRICS['import_seconds']:.2f}s, "
+        f"peak RSS {STARTUP_METRICS.get('max_rss_mb', 0):.1f} MB)"
+    )
+
 
 async def main():
     """تابع اصلی برای اجرای ربات"""
+    # Started first so the backlog delivered on connect is handled by the bounded pool
+    scheduler.start()
     await bot.start(bot_token=BOT_TOKEN)
     logger.info("Bot started...!")
     
     me = await bot.get_me()
     logger.info(f"Bot name: @{me.username}")
     
-    await bot.run_until_disconnected()
+    known_users.load(await db.get_known_user_ids())
+    logger.info(f"Loaded {len(known_users)} known users ({known_users.stats()['bytes'] / 1024:.0f} KB)")
+    log_startup_time()
+    
+    flusher = asyncio.create_task(activity_flusher())
+    supervisor = asyncio.create_task(supervise_worker()) if SPAWN_WORKER else None
+    instrumentation = await start_instrumentation(METRICS_PORT)
+    try:
+        await bot.run_until_disconnected()
+    finally:
+        await scheduler.stop()
+        await stop_instrumentation(*instrumentation)
+        flusher.cancel()
+        if supervisor:
+            supervisor.cancel()
+            await asyncio.gather(supervisor, return_exceptions=True)
+
+
+async def worker_main():
+    """تابع اصلی پروسه worker برای اجرای کارهای سنگین ادمین"""
+    # Stop gracefully on SIGTERM so running jobs save their progress
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, main_task.cancel)
+    
+    await bot.start(bot_token=BOT_TOKEN)
+    logger.info("Job worker started...!")
+    
+    # Random suffix so a restarted worker that reuses the pid never renews a crashed worker's leases
+    worker_id = f"{os.getpid()}-{os.urandom(4).hex()}"
+    await recover_jobs()
+    await enqueue_unfinished_broadcasts()
+    
+    leases = asyncio.create_task(lease_task(worker_id))
+    retention = asyncio.create_task(retention_task()) if ACTIVITY_RETENTION_DAYS > 0 else None
+    instrumentation = await start_instrumentation(METRICS_PORT + 1 if METRICS_PORT else 0)
+    try:
+        await job_worker(worker_id)
+    finally:
+        await stop_instrumentation(*instrumentation)
+        leases.cancel()
+        if retention:
+            retention.cancel()
+        await bot.disconnect()
 
 
 if __name__ == '__main__':
+    if '--startup-time' in sys.argv:
+        # Measure import and setup cost without connecting to Telegram
+        log_startup_time()
+        print(json.dumps(STARTUP_METRICS))
+        admin_states.close()
+        jobs.close()
+        db.close()
+        sys.exit(0)
     try:
-        asyncio.run(main())
+        asyncio.run(worker_main() if WORKER_MODE else main())
+    except asyncio.CancelledError:
+        pass
     finally:
+        admin_states.close()
+        jobs.close()
         db.close()